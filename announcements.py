@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""announcements.py
+
+Incrementally maintained "almost sold out" announcement.
+
+The set of conferences with 0 < seats <= ALMOST_SOLD_OUT_SEATS is kept in a
+single AlmostSoldOut entity, changed only when a registration (or the
+creation of a small conference) moves a conference across the threshold.
+memcache mirrors the set and the rendered announcement; both are dropped on
+every change and rebuilt from the entity by the next reader, so an eviction
+never loses the announcement. reconcile() repairs the set from the
+datastore and is run occasionally from cron.
+
+"""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import counters
+import entitycache
+from models import AlmostSoldOut
+from models import Conference
+
+
+ALMOST_SOLD_OUT_SEATS = 5
+MEMCACHE_ANNOUNCEMENT_KEY = "RECENT_ANNOUNCEMENTS"
+MEMCACHE_ALMOST_SOLD_OUT_KEY = "almost_sold_out"
+ANNOUNCEMENT_CACHE_SECONDS = 300
+ALMOST_SOLD_OUT_KEY = ndb.Key(AlmostSoldOut, 'conferences')
+
+
+def isAlmostSoldOut(seats):
+    """Return True if a conference with seats left should be announced."""
+    return 0 < seats <= ALMOST_SOLD_OUT_SEATS
+
+
+def _dropMirror():
+    """Drop the memcache copies of the set and the announcement."""
+    memcache.delete_multi([MEMCACHE_ALMOST_SOLD_OUT_KEY,
+                           MEMCACHE_ANNOUNCEMENT_KEY])
+
+
+def _loadConferences():
+    """Return the almost sold out conferences as {websafe key: name}."""
+    conferences = memcache.get(MEMCACHE_ALMOST_SOLD_OUT_KEY)
+    if conferences is None:
+        entity = ALMOST_SOLD_OUT_KEY.get()
+        conferences = (entity.conferences or {}) if entity else {}
+        memcache.add(MEMCACHE_ALMOST_SOLD_OUT_KEY, conferences,
+                     time=ANNOUNCEMENT_CACHE_SECONDS)
+    return conferences
+
+
+@ndb.transactional
+def _storeConferences(added=None, removed=None, replace=None):
+    """Change the stored set, dropping the memcache mirror on commit."""
+    entity = ALMOST_SOLD_OUT_KEY.get() or AlmostSoldOut(
+        key=ALMOST_SOLD_OUT_KEY, conferences={})
+    if replace is not None:
+        conferences = replace
+    else:
+        conferences = dict(entity.conferences or {})
+        conferences.update(added or {})
+        for wsck in removed or ():
+            conferences.pop(wsck, None)
+    if conferences != entity.conferences:
+        entity.conferences = conferences
+        entity.put()
+        ndb.get_context().call_on_commit(_dropMirror)
+    return conferences
+
+
+def seatsChanged(conf, seats):
+    """Update the set after the seats of conf changed to seats.
+
+    Only a move across the threshold writes to the datastore.
+    """
+    wsck = conf.key.urlsafe()
+    listed = wsck in _loadConferences()
+    if isAlmostSoldOut(seats) and not listed:
+        _storeConferences(added={wsck: conf.name})
+    elif listed and not isAlmostSoldOut(seats):
+        _storeConferences(removed=[wsck])
+
+
+def getAnnouncement():
+    """Return the announcement text ("" when nothing is almost sold out)."""
+    announcement = memcache.get(MEMCACHE_ANNOUNCEMENT_KEY)
+    if announcement is None:
+        conferences = _loadConferences()
+        if conferences:
+            announcement = '%s %s' % (
+                'Act soon! The following conferences '
+                'are almost sold out:',
+                ', '.join(sorted(conferences.values())))
+        else:
+            announcement = ""
+        memcache.add(MEMCACHE_ANNOUNCEMENT_KEY, announcement,
+                     time=ANNOUNCEMENT_CACHE_SECONDS)
+    return announcement
+
+
+def reconcile():
+    """Rebuild the set from the datastore, returning the announcement.
+
+    Candidates are the conferences whose stored seatsAvailable is in range
+    plus the current members; their live seat counts decide membership.
+    """
+    keys = set(Conference.query(ndb.AND(
+        Conference.seatsAvailable <= ALMOST_SOLD_OUT_SEATS,
+        Conference.seatsAvailable > 0)
+    ).fetch(keys_only=True))
+    keys.update(ndb.Key(urlsafe=wsck) for wsck in _loadConferences())
+
+    confs = [conf for conf in entitycache.getMulti(list(keys)) if conf]
+    counters.applySeatsAvailable(confs)
+    _storeConferences(replace=dict(
+        (conf.key.urlsafe(), conf.name) for conf in confs
+        if isAlmostSoldOut(conf.seatsAvailable or 0)))
+    _dropMirror()
+    return getAnnouncement()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""batchjobs.py
+
+Cursor-chunked batch jobs fanned out over the task queue.
+
+A job is registered under a name as a list of stages; each stage walks all
+entities of one kind and hands them, BATCH_CHUNK_SIZE at a time, to a map
+function that returns the entities to put and the keys to delete. Every
+stage is split into key-range shards (using the __scatter__ property) that
+run in parallel, each as a chain of tasks carrying the query cursor. The
+cursor is also stored on the shard's BatchJobShard entity and the next task
+is enqueued transactionally with it, so a repeated task delivery is skipped
+instead of processing a chunk twice.
+
+"""
+
+import datetime
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import entitycache
+from models import BatchJob
+from models import BatchJobShard
+
+
+BATCH_CHUNK_SIZE = 100
+BATCH_SHARDS = 4
+SCATTER_OVERSAMPLING = 32
+BATCH_TASK_URL = '/tasks/batch_job'
+
+_JOBS = {}
+
+
+def registerJob(name, stages):
+    """Register a job as a list of (model class, map function, keys_only).
+
+    The map function receives a list of entities (or keys for keys_only
+    stages) and returns a (entities to put, keys to delete) tuple.
+    """
+    _JOBS[name] = stages
+
+
+def registeredJobs():
+    """Return the names of all registered jobs."""
+    return sorted(_JOBS)
+
+
+def deleteKeys(keys):
+    """Map function deleting every key of a keys_only stage."""
+    return [], keys
+
+
+def _keyRanges(model_class, num_shards):
+    """Split the keys of model_class into up to num_shards (start, end) ranges."""
+    if num_shards <= 1:
+        return [(None, None)]
+    # __scatter__ is a random sample of keys maintained by the datastore
+    sample = model_class.query().order(
+        ndb.GenericProperty('__scatter__')).fetch(
+            num_shards * SCATTER_OVERSAMPLING, keys_only=True)
+    sample.sort()
+    if len(sample) < num_shards:
+        return [(None, None)]
+    step = len(sample) / float(num_shards)
+    splits = [sample[int(i * step)] for i in range(1, num_shards)]
+    bounds = [None] + splits + [None]
+    return zip(bounds[:-1], bounds[1:])
+
+
+def _shardTask(shard_key, cursor):
+    """Return the task that processes the next chunk of a shard."""
+    return taskqueue.Task(url=BATCH_TASK_URL,
+                          params={'shard': shard_key.id(),
+                                  'cursor': cursor or ''})
+
+
+def startJob(name, num_shards=BATCH_SHARDS):
+    """Start the registered job name, returning its BatchJob key."""
+    if name not in _JOBS:
+        raise ValueError('Unknown batch job: %s' % name)
+    job_key = ndb.Key(BatchJob, BatchJob.allocate_ids(size=1)[0])
+
+    shards = []
+    for stage, (model_class, mapper, keys_only) in enumerate(_JOBS[name]):
+        ranges = _keyRanges(model_class, num_shards)
+        for index, (start, end) in enumerate(ranges):
+            shards.append(BatchJobShard(
+                key=ndb.Key(BatchJobShard,
+                            '%d-%d-%d' % (job_key.id(), stage, index)),
+                jobId=job_key.id(), stage=stage, startKey=start, endKey=end))
+
+    job = BatchJob(key=job_key, name=name,
+                   shardKeys=[shard.key for shard in shards])
+    ndb.put_multi([job] + shards)
+
+    tasks = [_shardTask(shard.key, None) for shard in shards]
+    queue = taskqueue.Queue()
+    for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+        queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+    return job_key
+
+
+def _shardQuery(model_class, shard):
+    """Return the key-ordered query over a shard's key range."""
+    query = model_class.query()
+    if shard.startKey:
+        query = query.filter(model_class._key >= shard.startKey)
+    if shard.endKey:
+        query = query.filter(model_class._key < shard.endKey)
+    return query.order(model_class._key)
+
+
+@ndb.transactional
+def _advanceShard(shard_key, cursor, next_cursor, processed):
+    """Record a processed chunk and chain the next one."""
+    shard = shard_key.get()
+    if shard.done or (shard.cursor or '') != cursor:
+        # chunk was already recorded by an earlier delivery of this task
+        return
+    shard.processed += processed
+    shard.cursor = next_cursor
+    shard.done = not next_cursor
+    shard.put()
+    if next_cursor:
+        _shardTask(shard_key, next_cursor).add(transactional=True)
+
+
+def runChunk(shard_id, cursor):
+    """Process the chunk of shard_id starting at cursor ('' for the first)."""
+    shard = ndb.Key(BatchJobShard, shard_id).get()
+    if not shard or shard.done or (shard.cursor or '') != cursor:
+        return
+    job = ndb.Key(BatchJob, shard.jobId).get()
+    model_class, mapper, keys_only = _JOBS[job.name][shard.stage]
+
+    start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    results, next_cursor, more = _shardQuery(model_class, shard).fetch_page(
+        BATCH_CHUNK_SIZE, start_cursor=start_cursor, keys_only=keys_only)
+
+    to_put, to_delete = mapper(results)
+    with entitycache.batch():
+        if to_put:
+            ndb.put_multi(to_put)
+        if to_delete:
+            ndb.delete_multi(to_delete)
+
+    _advanceShard(shard.key, cursor,
+                  next_cursor.urlsafe() if (more and next_cursor) else None,
+                  len(results))
+
+
+def getStatus(job_id):
+    """Return a dict describing the progress of a BatchJob, or None."""
+    job = ndb.Key(BatchJob, job_id).get()
+    if not job:
+        return None
+    shards = [shard for shard in ndb.get_multi(job.shardKeys) if shard]
+    done = [shard for shard in shards if shard.done]
+    last_update = max([shard.updated for shard in shards] or [job.created])
+    finished = len(done) == len(job.shardKeys)
+    elapsed = ((last_update if finished else datetime.datetime.utcnow())
+               - job.created)
+    return {
+        'jobId': job.key.id(),
+        'name': job.name,
+        'status': 'done' if finished else 'running',
+        'shards': len(job.shardKeys),
+        'shardsDone': len(done),
+        'processed': sum(shard.processed for shard in shards),
+        'created': job.created.isoformat(),
+        'elapsedSeconds': elapsed.total_seconds(),
+    }
@@ -0,0 +1,906 @@
+#!/usr/bin/env python
+
+"""benchmark.py
+
+Latency benchmark of the ConferenceApi endpoints and the main.py handlers
+on the local App Engine testbed stubs (datastore, memcache, taskqueue).
+
+For every scale, synthetic profiles, conferences and sessions are seeded
+(with their seat shards, search documents and speaker indexes). Then every
+endpoint and handler is called --iterations times. Each call is a fresh
+request: new request log ID and an empty ndb context cache. The report
+gives p50/p99 latency, datastore RPCs and entities read per call as JSON,
+so runs of different releases can be diffed.
+
+    python benchmark.py --sdk ~/google_appengine \\
+        --sessions 1000 --sessions 10000 --sessions 100000 \\
+        --output benchmark.json
+
+Tasks enqueued by the calls are recorded by the taskqueue stub but not run.
+
+--mode registration is a load test of conference registration instead:
+--threads concurrent workers register --registrations users for one
+conference, once per --shards seat shard count, and the report gives
+registrations per second and the transactions that failed after retries.
+
+    python benchmark.py --sdk ~/google_appengine --mode registration \\
+        --shards 1 --shards 5 --shards 20 --threads 20
+
+--mode attending compares getConferencesToAttend for a profile registered
+for --registered conferences (default 10, 100 and 1000): the tasklet
+pipeline of the endpoint against the same reads issued one after another,
+each with a cold and a warm memcache.
+
+--mode converters is a micro-benchmark of converters.py: it converts
+in-memory Profiles, Conferences and Sessions to their forms with the
+precompiled converters and with the field-by-field reflection they
+replaced, and reports microseconds per entity for both.
+
+--mode auth times getUserId(..., id_type="oauth") against a local stand-in
+for the tokeninfo service, served through the urlfetch stub with
+--tokeninfo-ms of simulated latency. Valid and failing tokens are each
+looked up with cold caches, with only memcache warm (a new instance) and
+with the in-process cache warm; the email lookup is the no-auth baseline.
+
+    python benchmark.py --sdk ~/google_appengine --mode auth \
+        --tokeninfo-ms 50
+
+"""
+
+import Queue
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib
+import uuid
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+SESSIONS_PER_CONFERENCE = 20
+CONFERENCES_PER_ORGANIZER = 5
+SEED_BATCH_SIZE = 500
+CITIES = ['London', 'Chicago', 'Paris', 'Tokyo', 'San Francisco']
+TOPICS = ['Web', 'Mobile', 'Cloud', 'Data', 'Security', 'Design']
+SESSION_TYPES = ['lecture', 'keynote', 'workshop', 'panel']
+WORDS = ['python', 'cloud', 'machine', 'learning', 'datastore', 'mobile',
+         'web', 'security', 'design', 'testing', 'performance', 'scaling',
+         'android', 'ios', 'api', 'streaming', 'search', 'caching']
+BENCH_EMAIL = 'organizer0@example.com'
+CONVERTER_ENTITIES = 1000
+TOKENINFO_LATENCY_MS = 50
+
+
+def _setUpSdk(sdk_path):
+    """Put the App Engine SDK and its bundled libraries on sys.path."""
+    if sdk_path:
+        sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+
+
+def _activateTestbed():
+    """Activate the stubs; must happen before the app modules are imported.
+
+    Activation replaces the apiproxy, so hooks the app installs at import
+    time (requestcontext's RPC counter) only survive if they come after.
+    """
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1),
+        require_indexes=False)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+    bed.init_urlfetch_stub()
+    bed.init_mail_stub()
+    bed.init_user_stub()
+    bed.init_app_identity_stub()
+    return bed
+
+
+class RpcCounter(object):
+
+    """RpcCounter -- datastore RPCs and entities read since reset()"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.rpcs = 0
+        self.entities = 0
+
+    def record(self, service, call, request, response):
+        """apiproxy post-call hook."""
+        if service != 'datastore_v3':
+            return
+        self.rpcs += 1
+        if call == 'Get':
+            self.entities += sum(1 for result in response.entity_list()
+                                 if result.has_entity())
+        elif call in ('RunQuery', 'Next'):
+            self.entities += response.result_size()
+
+
+def _percentile(values, fraction):
+    """Return the nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))
+    return values[index]
+
+
+def _summarize(samples):
+    """Return the JSON summary of (seconds, rpcs, entities, error) samples."""
+    latencies = sorted(sample[0] * 1000.0 for sample in samples)
+    calls = len(samples)
+    errors = [sample[3] for sample in samples if sample[3]]
+    return {
+        'calls': calls,
+        'errors': len(errors),
+        'lastError': errors[-1] if errors else None,
+        'p50Ms': _percentile(latencies, 0.50),
+        'p99Ms': _percentile(latencies, 0.99),
+        'datastoreRpcsPerCall': float(sum(s[1] for s in samples)) / calls,
+        'entitiesReadPerCall': float(sum(s[2] for s in samples)) / calls,
+    }
+
+
+class Benchmark(object):
+
+    """Benchmark -- seeds one scale and times every endpoint and handler"""
+
+    def __init__(self, bed, counter, rng):
+        # app modules are imported only once the testbed is active
+        from google.appengine.ext import ndb
+        import conference
+        import counters
+        import main
+        import models
+        import speakerindex
+        import textsearch
+        import timetable
+
+        self.bed = bed
+        self.counter = counter
+        self.rng = rng
+        self.ndb = ndb
+        self.conference = conference
+        self.counters = counters
+        self.main = main
+        self.models = models
+        self.speakerindex = speakerindex
+        self.textsearch = textsearch
+        self.timetable = timetable
+        self.api = conference.ConferenceApi()
+        os.environ['ENDPOINTS_AUTH_EMAIL'] = BENCH_EMAIL
+        os.environ['ENDPOINTS_AUTH_DOMAIN'] = 'example.com'
+
+    # - - - fixture - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def reset(self):
+        """Empty the datastore, memcache and task queues."""
+        from google.appengine.api import memcache
+        self.bed.get_stub('datastore_v3').Clear()
+        memcache.flush_all()
+        taskqueue_stub = self.bed.get_stub('taskqueue')
+        for queue in taskqueue_stub.GetQueues():
+            taskqueue_stub.FlushQueue(queue['name'])
+
+    def _putBatched(self, entities):
+        """Write entities in SEED_BATCH_SIZE put_multi calls."""
+        for i in range(0, len(entities), SEED_BATCH_SIZE):
+            self.ndb.put_multi(entities[i:i + SEED_BATCH_SIZE])
+
+    def seed(self, num_sessions):
+        """Create the synthetic data set for num_sessions sessions."""
+        from speakers import addSessions as addToSpeakers
+        models, ndb, rng = self.models, self.ndb, self.rng
+        num_confs = max(1, num_sessions // SESSIONS_PER_CONFERENCE)
+        num_profiles = max(1, num_confs // CONFERENCES_PER_ORGANIZER)
+        speakers = ['Speaker %d' % i
+                    for i in range(max(10, num_sessions // 10))]
+
+        profiles = [models.Profile(
+            key=ndb.Key(models.Profile, 'organizer%d@example.com' % i),
+            displayName='Organizer %d' % i,
+            mainEmail='organizer%d@example.com' % i)
+            for i in range(num_profiles)]
+
+        # reserved IDs, so conferences/sessions created by the timed calls
+        # never collide with seeded ones
+        first_conf_id, _ = models.Conference.allocate_ids(size=num_confs)
+        first_session_id, _ = models.Session.allocate_ids(size=num_sessions)
+
+        conferences = []
+        related = []
+        for i in range(num_confs):
+            organizer = profiles[i % num_profiles]
+            start = date(2016, 1, 1) + timedelta(days=rng.randint(0, 360))
+            max_attendees = rng.choice([10, 50, 200, 1000])
+            conf = models.Conference(
+                key=ndb.Key(models.Conference, first_conf_id + i,
+                            parent=organizer.key),
+                name='%s %s Conference %d' % (
+                    rng.choice(WORDS).title(), rng.choice(WORDS).title(), i),
+                description=' '.join(rng.sample(WORDS, 6)),
+                organizerUserId=organizer.key.id(),
+                organizerDisplayName=organizer.displayName,
+                topics=rng.sample(TOPICS, 2),
+                city=rng.choice(CITIES),
+                startDate=start,
+                endDate=start + timedelta(days=2),
+                month=start.month,
+                maxAttendees=max_attendees,
+                seatsAvailable=max_attendees,
+                seatShards=self.conference.SEAT_SHARDS)
+            conferences.append(conf)
+            related.append(self.textsearch.documentFor(conf))
+            related.extend(self.counters.createShards(
+                conf.key, max_attendees, conf.seatShards))
+
+        sessions = []
+        for j in range(num_sessions):
+            conf = conferences[j % num_confs]
+            session = models.Session(
+                key=ndb.Key(models.Session, first_session_id + j,
+                            parent=conf.key),
+                name='%s %s' % (rng.choice(WORDS).title(),
+                                rng.choice(WORDS).title()),
+                highlights=' '.join(rng.sample(WORDS, 3)),
+                speaker=rng.choice(speakers),
+                duration=rng.choice([30, 45, 60, 90, 120]),
+                typeOfSession=[rng.choice(SESSION_TYPES)],
+                date=conf.startDate + timedelta(days=j % 3),
+                startTime=datetime(
+                    2000, 1, 1, 9 + j % 9, 30 * (j % 2)).time())
+            sessions.append(session)
+            related.append(self.textsearch.documentFor(session))
+
+        bench_profile = profiles[0]
+        bench_profile.conferenceKeysToAttend = [
+            conf.key.urlsafe() for conf in conferences[:10]]
+        bench_profile.sessionKeysInWishlist = [
+            session.key.urlsafe() for session in sessions[:10]]
+
+        self._putBatched(profiles + conferences + sessions + related)
+        addToSpeakers(sessions)
+        for conf in conferences:
+            self.speakerindex.ensureIndex(conf.key)
+            self.timetable.ensureTimetable(conf.key)
+
+        self.confKeys = [conf.key.urlsafe() for conf in conferences]
+        self.ownConfKeys = [conf.key.urlsafe() for conf in conferences
+                            if conf.key.parent() == bench_profile.key]
+        self.sessionKeys = [session.key.urlsafe() for session in sessions]
+        self.speakers = speakers
+        self.userIds = [profile.key.id() for profile in profiles]
+        self.jobId = None
+        return {'profiles': num_profiles, 'conferences': num_confs,
+                'sessions': num_sessions}
+
+    # - - - requests - - - - - - - - - - - - - - - - - - - - - - -
+
+    def _sessionForm(self, message_class=None, **extra):
+        """Return a SessionForm (or message_class) for a new session."""
+        return (message_class or self.models.SessionForm)(
+            name='Bench %s' % self.rng.choice(WORDS),
+            highlights=' '.join(self.rng.sample(WORDS, 3)),
+            speaker=self.rng.choice(self.speakers),
+            duration=60, typeOfSession=['lecture'],
+            date='2016-06-01', startTime='10, 00', **extra)
+
+    def endpointRequests(self):
+        """Return {endpoint name: function returning its request}."""
+        c, m, rng = self.conference, self.models, self.rng
+        conf = lambda: rng.choice(self.confKeys)
+        page = lambda: c.CONF_PAGE_REQUEST.combined_message_class()
+        void = lambda: c.message_types.VoidMessage()
+        return {
+            'getProfile': void,
+            'saveProfile': lambda: m.ProfileMiniForm(
+                displayName='Organizer %d' % rng.randint(0, 1000)),
+            'queryConferences': lambda: m.ConferenceQueryForms(filters=[
+                m.ConferenceQueryForm(field='CITY', operator='EQ',
+                                      value=rng.choice(CITIES))]),
+            'filterPlayground': page,
+            'getSmallConferences': page,
+            'createConference': lambda: m.ConferenceForm(
+                name='Bench Conference %s' % uuid.uuid4().hex[:8],
+                description=' '.join(rng.sample(WORDS, 6)),
+                topics=rng.sample(TOPICS, 2), city=rng.choice(CITIES),
+                startDate='2016-06-01', endDate='2016-06-03',
+                maxAttendees=100),
+            'getConferencesCreated': page,
+            'registerForConference':
+                lambda: c.CONF_GET_REQUEST.combined_message_class(
+                    websafeConferenceKey=conf()),
+            'createSession':
+                lambda: self._sessionForm(
+                    c.SESSION_POST_REQUEST.combined_message_class,
+                    websafeConferenceKey=rng.choice(self.ownConfKeys)),
+            'createSessions':
+                lambda: c.SESSIONS_POST_REQUEST.combined_message_class(
+                    websafeConferenceKey=rng.choice(self.ownConfKeys),
+                    items=[self._sessionForm() for i in range(5)]),
+            'getConferenceSessions':
+                lambda: c.CONF_SESSIONS_REQUEST.combined_message_class(
+                    websafeConferenceKey=conf()),
+            'querySessionsByTime':
+                lambda: c.SESSION_TIME_QUERY_REQUEST.combined_message_class(
+                    websafeConferenceKey=conf(), windowStart='14, 00',
+                    windowEnd='15, 00', excludedTypes=['workshop']),
+            'getSessionsByHighlights':
+                lambda: c.SESSION_GET_BY_HIGHLIGHTS_REQUEST
+                .combined_message_class(highlights=rng.choice(WORDS)),
+            'searchSessions':
+                lambda: c.SEARCH_REQUEST.combined_message_class(
+                    query='%s* %s' % (rng.choice(WORDS)[:4],
+                                      rng.choice(WORDS))),
+            'searchConferences':
+                lambda: c.SEARCH_REQUEST.combined_message_class(
+                    query=rng.choice(WORDS)),
+            'getConferenceSessionsByType':
+                lambda: c.SESSION_GET_REQUEST_BY_TYPE.combined_message_class(
+                    websafeConferenceKey=conf(),
+                    typeOfSession=rng.choice(SESSION_TYPES)),
+            'getSessionsBySpeaker':
+                lambda: c.SESSION_GET_BY_SPEAKER_REQUEST
+                .combined_message_class(speaker=rng.choice(self.speakers)),
+            'getConferencesToAttend':
+                lambda: c.FIELDS_REQUEST.combined_message_class(),
+            'clearAllData': void,
+            'addSessionToWishlist':
+                lambda: c.SESSION_REQUEST.combined_message_class(
+                    sessionKey=rng.choice(self.sessionKeys)),
+            'deleteSessionInWishlist':
+                lambda: c.SESSION_REQUEST.combined_message_class(
+                    sessionKey=rng.choice(self.sessionKeys)),
+            'getSessionsInWishlist': void,
+            'getFeaturedSpeaker':
+                lambda: c.FEATURED_SPEAKER_REQUEST.combined_message_class(
+                    websafeConferenceKey=conf()),
+            'getAnnouncement': void,
+            'getSpeakers':
+                lambda: c.SPEAKERS_REQUEST.combined_message_class(),
+            'queueRegistration':
+                lambda: c.CONF_GET_REQUEST.combined_message_class(
+                    websafeConferenceKey=conf()),
+        }
+
+    def _batchShardParams(self):
+        """Return the params of the next chunk of a running batch job."""
+        import batchjobs
+        from models import BatchJobShard
+        if self.jobId is None:
+            self.jobId = batchjobs.startJob('backfill_search_index').id()
+        shard = self.ndb.Key(BatchJobShard, '%d-0-0' % self.jobId).get()
+        if shard.done:
+            self.jobId = None
+            return self._batchShardParams()
+        return {'shard': shard.key.id(), 'cursor': shard.cursor or ''}
+
+    def handlerRequests(self):
+        """Return {route: function returning (method, params, body)}."""
+        import datatransfer
+        rng = self.rng
+        import_body = ''.join(
+            line for line in datatransfer.exportLines(max_entities=20)
+            if '"summary"' not in line)
+        return {
+            '/admin/cache_stats': lambda: ('GET', {}, None),
+            '/admin/export': lambda: ('GET', {}, None),
+            '/admin/import': lambda: ('POST', {}, import_body),
+            '/admin/jobs/start':
+                lambda: ('POST', {'name': 'backfill_search_index'}, None),
+            '/admin/metrics': lambda: ('GET', {}, None),
+            '/admin/jobs/status':
+                lambda: ('GET', {'job': str(self._jobIdForStatus())}, None),
+            '/crons/set_announcement': lambda: ('GET', {}, None),
+            '/tasks/send_mail': lambda: ('POST', {}, None),
+            '/tasks/sync_seats_available':
+                lambda: ('POST', {'wsck': rng.choice(self.confKeys)}, None),
+            '/tasks/process_registrations':
+                lambda: ('POST', {'wsck': rng.choice(self.confKeys)}, None),
+            '/tasks/update_speakers':
+                lambda: ('POST', {'sessionKeys': ' '.join(
+                    rng.sample(self.sessionKeys, 5))}, None),
+            '/tasks/update_organizer_names':
+                lambda: ('POST', {'userId': rng.choice(self.userIds)}, None),
+            '/tasks/batch_job':
+                lambda: ('POST', self._batchShardParams(), None),
+        }
+
+    def _jobIdForStatus(self):
+        """Return the ID of a batch job to ask the status of."""
+        if self.jobId is None:
+            self._batchShardParams()
+        return self.jobId
+
+    # - - - timing - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def _newRequest(self):
+        """Make the next call look like a new request to the app."""
+        os.environ['REQUEST_LOG_ID'] = uuid.uuid4().hex
+        self.ndb.get_context().clear_cache()
+        self.counter.reset()
+
+    def _time(self, call):
+        """Run call once, returning (seconds, rpcs, entities, error)."""
+        self._newRequest()
+        error = None
+        started = time.time()
+        try:
+            call()
+        except Exception as e:
+            error = '%s: %s' % (type(e).__name__, e)
+        elapsed = time.time() - started
+        return elapsed, self.counter.rpcs, self.counter.entities, error
+
+    def runEndpoints(self, iterations, warmup):
+        """Time every ConferenceApi method, returning {name: summary}."""
+        builders = self.endpointRequests()
+        results = {}
+        for name in sorted(self.conference.ConferenceApi
+                           .all_remote_methods()):
+            if name not in builders:
+                results[name] = {'skipped': 'no request builder'}
+                continue
+            method = getattr(self.api, name)
+            call = lambda: method(builders[name]())
+            for i in range(warmup):
+                self._time(call)
+            results[name] = _summarize(
+                [self._time(call) for i in range(iterations)])
+        return results
+
+    def runHandlers(self, iterations, warmup):
+        """Time every main.py route, returning {route: summary}."""
+        builders = self.handlerRequests()
+        results = {}
+        for route in self.main.app.router.match_routes:
+            path = route.template
+            if path not in builders:
+                results[path] = {'skipped': 'no request builder'}
+                continue
+
+            def call():
+                method, params, body = builders[path]()
+                if method == 'GET':
+                    response = self.main.app.get_response(
+                        '%s?%s' % (path, urllib.urlencode(params)))
+                elif body is not None:
+                    response = self.main.app.get_response(
+                        path, method='POST', body=body)
+                else:
+                    response = self.main.app.get_response(
+                        path, method='POST', POST=params)
+                if response.status_int >= 400:
+                    raise RuntimeError(response.status)
+
+            for i in range(warmup):
+                self._time(call)
+            results[path] = _summarize(
+                [self._time(call) for i in range(iterations)])
+        return results
+
+
+class RegistrationLoad(object):
+
+    """RegistrationLoad -- concurrent registrations for one conference"""
+
+    def __init__(self, bench):
+        import counters
+        self.bench = bench
+        self.counters = counters
+
+    def _seed(self, num_shards, num_users):
+        """Store num_users profiles and a conference with num_users seats."""
+        models, ndb = self.bench.models, self.bench.ndb
+        profiles = [models.Profile(key=ndb.Key(models.Profile, 'load%d' % i),
+                                   displayName='Load %d' % i,
+                                   mainEmail='load%d@example.com' % i)
+                    for i in range(num_users)]
+        c_key = ndb.Key(models.Conference, 1, parent=profiles[0].key)
+        conf = models.Conference(
+            key=c_key, name='Load test', organizerUserId='load0',
+            maxAttendees=num_users, seatsAvailable=num_users,
+            seatShards=num_shards)
+        self.bench._putBatched(
+            profiles + [conf] +
+            self.counters.createShards(c_key, num_users, num_shards))
+        return conf, profiles
+
+    def run(self, num_shards, num_users, num_threads):
+        """Register every user with num_threads workers; returns a summary."""
+        self.bench.reset()
+        conf, profiles = self._seed(num_shards, num_users)
+        wsck = conf.key.urlsafe()
+        pending = Queue.Queue()
+        for profile in profiles:
+            pending.put(profile)
+        lock = threading.Lock()
+        samples = []
+
+        def worker():
+            while True:
+                try:
+                    profile = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                error = None
+                started = time.time()
+                try:
+                    if not self.bench.api._moveSeat(profile, conf, wsck):
+                        error = 'sold out'
+                except Exception as e:
+                    # e.g. TransactionFailedError once ndb gave up retrying
+                    error = '%s: %s' % (type(e).__name__, e)
+                with lock:
+                    samples.append((time.time() - started, 0, 0, error))
+
+        workers = [threading.Thread(target=worker)
+                   for i in range(num_threads)]
+        started = time.time()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.time() - started
+
+        summary = _summarize(samples)
+        del summary['datastoreRpcsPerCall'], summary['entitiesReadPerCall']
+        registered = summary['calls'] - summary['errors']
+        summary.update({
+            'shards': num_shards,
+            'threads': num_threads,
+            'registered': registered,
+            'seconds': elapsed,
+            'registrationsPerSecond': registered / elapsed if elapsed else None,
+            'seatsTaken': sum(shard.seatsTaken for shard in
+                              self.counters.getShards(conf) if shard),
+        })
+        return summary
+
+
+class AttendingComparison(object):
+
+    """AttendingComparison -- pipelined vs sequential conference reads"""
+
+    def __init__(self, bench):
+        import converters
+        import counters
+        import entitycache
+        self.bench = bench
+        self.converters = converters
+        self.counters = counters
+        self.entitycache = entitycache
+
+    def _seed(self, num_confs):
+        """Store num_confs conferences and a profile registered for all."""
+        models, ndb = self.bench.models, self.bench.ndb
+        organizers = [models.Profile(key=ndb.Key(models.Profile, 'org%d' % i),
+                                     displayName='Organizer %d' % i)
+                      for i in range(max(1, num_confs // 5))]
+        conferences = []
+        shards = []
+        for i in range(num_confs):
+            organizer = organizers[i % len(organizers)]
+            conf = models.Conference(
+                key=ndb.Key(models.Conference, i + 1, parent=organizer.key),
+                name='Conference %d' % i, city=CITIES[i % len(CITIES)],
+                organizerUserId=organizer.key.id(),
+                organizerDisplayName=organizer.displayName,
+                maxAttendees=100, seatsAvailable=100,
+                seatShards=self.counters.SEAT_SHARDS)
+            conferences.append(conf)
+            shards.extend(self.counters.createShards(conf.key, 100))
+        attendee = models.Profile(
+            key=ndb.Key(models.Profile, 'attendee'), displayName='Attendee',
+            conferenceKeysToAttend=[conf.key.urlsafe()
+                                    for conf in conferences])
+        self.bench._putBatched(organizers + conferences + shards + [attendee])
+        return attendee
+
+    def _sequential(self, profile):
+        """The endpoint's reads, each waiting for the previous one."""
+        conf_keys = [self.bench.ndb.Key(urlsafe=wsck)
+                     for wsck in profile.conferenceKeysToAttend]
+        conferences = [conf for conf in self.entitycache.getMulti(conf_keys)
+                       if conf]
+        self.counters.applySeatsAvailable(conferences)
+        return [self.converters.conferenceToForm(conf)
+                for conf in conferences]
+
+    def _pipelined(self, profile):
+        """The endpoint's tasklet pipeline."""
+        return self.bench.api._conferencesToAttendAsync(profile).get_result()
+
+    def run(self, num_confs, iterations):
+        """Time both variants, cold and warm; returns a summary."""
+        from google.appengine.api import memcache
+        self.bench.reset()
+        profile = self._seed(num_confs)
+        result = {'registeredConferences': num_confs}
+        for name, call in (('sequential', self._sequential),
+                           ('pipelined', self._pipelined)):
+            for cache in ('cold', 'warm'):
+                samples = []
+                for i in range(iterations + 1):
+                    if cache == 'cold':
+                        memcache.flush_all()
+                    sample = self.bench._time(lambda: call(profile))
+                    # the first warm call only fills memcache
+                    if cache == 'cold' or i:
+                        samples.append(sample)
+                result['%s-%s' % (name, cache)] = _summarize(samples)
+        return result
+
+
+class AuthOverhead(object):
+
+    """AuthOverhead -- OAuth user ID lookups against a local tokeninfo"""
+
+    def __init__(self, bench, latency_ms):
+        import settings
+        import utils
+        self.bench = bench
+        self.utils = utils
+        self.latency = latency_ms / 1000.0
+        self.prefix = settings.TOKENINFO_URL.split('?')[0]
+        self.fetches = 0
+
+    def _install(self):
+        """Answer tokeninfo URLs in the urlfetch stub instead of the network.
+
+        Tokens starting with 'valid' belong to a user; any other token is
+        rejected as invalid_token, like the real service does.
+        """
+        stub = self.bench.bed.get_stub('urlfetch')
+        fetch = stub._Dynamic_Fetch
+
+        def tokeninfo(request, response):
+            url = request.url()
+            if not url.startswith(self.prefix):
+                return fetch(request, response)
+            self.fetches += 1
+            time.sleep(self.latency)
+            token = url.rpartition('=')[2]
+            if token.startswith('valid'):
+                response.set_statuscode(200)
+                response.set_content(json.dumps({
+                    'user_id': 'user-' + token, 'expires_in': 3600,
+                    'email': BENCH_EMAIL}))
+            else:
+                response.set_statuscode(400)
+                response.set_content(json.dumps({
+                    'error': 'invalid_token',
+                    'error_description': 'Invalid Value'}))
+        stub._Dynamic_Fetch = tokeninfo
+
+    def _forgetInstance(self):
+        """Empty the in-process token cache, as on a new instance."""
+        self.utils._token_cache = self.utils._LRUCache(
+            self.utils.TOKEN_CACHE_SIZE)
+
+    def _lookups(self, call, cache, iterations):
+        """Time call with the given cache state; returns a summary."""
+        from google.appengine.api import memcache
+        samples = []
+        fetches = self.fetches
+        # the first call only fills the caches of the warm states
+        for i in range(iterations + (cache != 'cold')):
+            if cache == 'cold':
+                memcache.flush_all()
+            if cache != 'warm':
+                self._forgetInstance()
+            if i == 0 and cache != 'cold':
+                call()
+                fetches = self.fetches
+                continue
+            samples.append(self.bench._time(call))
+        summary = _summarize(samples)
+        summary['tokeninfoFetchesPerCall'] = (
+            float(self.fetches - fetches) / iterations)
+        return summary
+
+    def run(self, iterations):
+        """Time email and OAuth user ID lookups; returns a summary."""
+        from google.appengine.api import users
+        self.bench.reset()
+        self._install()
+        user = users.User(BENCH_EMAIL)
+        result = {'tokeninfoLatencyMs': self.latency * 1000.0,
+                  'email': self._lookups(
+                      lambda: self.utils.getUserId(user), 'warm', iterations)}
+        for token in ('valid-token', 'revoked-token'):
+            def call():
+                os.environ['HTTP_AUTHORIZATION'] = 'Bearer ' + token
+                return self.utils.getUserId(user, id_type='oauth')
+            for cache in ('cold', 'memcache', 'warm'):
+                result['%s-%s' % (token.split('-')[0], cache)] = \
+                    self._lookups(call, cache, iterations)
+        os.environ.pop('HTTP_AUTHORIZATION', None)
+        return result
+
+
+def _reflectiveToForm(entity, message_class, key_field=None):
+    """Entity -> form conversion as done before converters.py."""
+    form = message_class()
+    for field in form.all_fields():
+        if hasattr(entity, field.name):
+            value = getattr(entity, field.name)
+            if field.name.endswith('Date') or field.name in ('date',
+                                                             'startTime'):
+                setattr(form, field.name, str(value))
+            elif field.name == 'teeShirtSize':
+                setattr(form, field.name, getattr(field.type, value))
+            else:
+                setattr(form, field.name, value)
+        elif field.name == key_field:
+            setattr(form, field.name, entity.key.urlsafe())
+    form.check_initialized()
+    return form
+
+
+class ConverterComparison(object):
+
+    """ConverterComparison -- precompiled vs reflective form conversion"""
+
+    def __init__(self, bench):
+        import converters
+        self.bench = bench
+        self.converters = converters
+
+    def _entities(self, count):
+        """Return (name, entities, precompiled, reflective) per model."""
+        models, ndb, rng = self.bench.models, self.bench.ndb, self.bench.rng
+        profiles = [models.Profile(
+            key=ndb.Key(models.Profile, 'user%d' % i),
+            displayName='User %d' % i, mainEmail='user%d@example.com' % i,
+            teeShirtSize='M_M',
+            conferenceKeysToAttend=['k%d' % j for j in range(5)])
+            for i in range(count)]
+        conferences = [models.Conference(
+            key=ndb.Key(models.Conference, i + 1, parent=profiles[i].key),
+            name='Conference %d' % i, description=' '.join(WORDS[:8]),
+            topics=rng.sample(TOPICS, 2), city=rng.choice(CITIES),
+            startDate=date(2016, 1 + i % 12, 1),
+            endDate=date(2016, 1 + i % 12, 3), month=1 + i % 12,
+            maxAttendees=100, seatsAvailable=50,
+            organizerUserId='user%d' % i)
+            for i in range(count)]
+        sessions = [models.Session(
+            key=ndb.Key(models.Session, i + 1, parent=conferences[i].key),
+            name='Session %d' % i, highlights=' '.join(WORDS[:4]),
+            speaker='Speaker %d' % i, duration=60,
+            typeOfSession=[rng.choice(SESSION_TYPES)],
+            date=date(2016, 1, 1), startTime=datetime(2000, 1, 1, 9).time())
+            for i in range(count)]
+        c = self.converters
+        return [
+            ('Profile', profiles, c.profileToForm,
+             lambda e: _reflectiveToForm(e, self.bench.models.ProfileForm)),
+            ('Conference', conferences, c.conferenceToForm,
+             lambda e: _reflectiveToForm(e, self.bench.models.ConferenceForm,
+                                         'websafeKey')),
+            ('Session', sessions, c.sessionToForm,
+             lambda e: _reflectiveToForm(e, self.bench.models.SessionForm,
+                                         'sessionSafeKey')),
+        ]
+
+    def run(self, count, iterations):
+        """Time both conversions; returns {model: summary}."""
+        result = {'entities': count}
+        for name, entities, precompiled, reflective in self._entities(count):
+            timings = {}
+            for variant, convert in (('precompiled', precompiled),
+                                     ('reflective', reflective)):
+                best = None
+                for i in range(iterations):
+                    started = time.time()
+                    for entity in entities:
+                        convert(entity)
+                    elapsed = time.time() - started
+                    best = elapsed if best is None else min(best, elapsed)
+                timings[variant + 'UsPerEntity'] = best * 1e6 / count
+            timings['speedup'] = (timings['reflectiveUsPerEntity'] /
+                                  timings['precompiledUsPerEntity'])
+            result[name] = timings
+        return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sdk', help='path of the App Engine SDK')
+    parser.add_argument('--sessions', type=int, action='append',
+                        help='scale(s) to run, in sessions (default 1000)')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed of the synthetic data')
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    parser.add_argument('--mode',
+                        choices=('endpoints', 'registration', 'attending',
+                                 'converters', 'auth'),
+                        default='endpoints')
+    parser.add_argument('--shards', type=int, action='append',
+                        help='registration: seat shard count(s) to run '
+                             '(default 1, 2, 5, 10, 20)')
+    parser.add_argument('--registrations', type=int, default=500,
+                        help='registration: users registering per run')
+    parser.add_argument('--threads', type=int, default=10,
+                        help='registration: concurrent workers')
+    parser.add_argument('--registered', type=int, action='append',
+                        help='attending: registered conference count(s) '
+                             '(default 10, 100, 1000)')
+    parser.add_argument('--tokeninfo-ms', type=float,
+                        default=TOKENINFO_LATENCY_MS,
+                        help='auth: simulated tokeninfo latency')
+    args = parser.parse_args(argv)
+
+    _setUpSdk(args.sdk)
+    bed = _activateTestbed()
+    from google.appengine.api import apiproxy_stub_map
+    counter = RpcCounter()
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        'benchmark', counter.record)
+    bench = Benchmark(bed, counter, random.Random(args.seed))
+
+    report = {'generatedAt': datetime.utcnow().isoformat(),
+              'mode': args.mode}
+    if args.mode == 'registration':
+        load = RegistrationLoad(bench)
+        report['runs'] = [
+            load.run(num_shards, args.registrations, args.threads)
+            for num_shards in args.shards or [1, 2, 5, 10, 20]]
+    elif args.mode == 'converters':
+        report['iterations'] = args.iterations
+        report['runs'] = [ConverterComparison(bench).run(
+            CONVERTER_ENTITIES, args.iterations)]
+    elif args.mode == 'auth':
+        report['iterations'] = args.iterations
+        report['runs'] = [AuthOverhead(bench, args.tokeninfo_ms).run(
+            args.iterations)]
+    elif args.mode == 'attending':
+        comparison = AttendingComparison(bench)
+        report['iterations'] = args.iterations
+        report['runs'] = [
+            comparison.run(num_confs, args.iterations)
+            for num_confs in args.registered or [10, 100, 1000]]
+    else:
+        report.update({'iterations': args.iterations, 'scales': []})
+        for num_sessions in args.sessions or [1000]:
+            bench.reset()
+            started = time.time()
+            scale = bench.seed(num_sessions)
+            scale['seedSeconds'] = time.time() - started
+            scale['endpoints'] = bench.runEndpoints(
+                args.iterations, args.warmup)
+            scale['handlers'] = bench.runHandlers(
+                args.iterations, args.warmup)
+            report['scales'].append(scale)
+    bed.deactivate()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
@@ -13,7 +13,6 @@ created by wesc on 2014 apr 21
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 
-from datetime import datetime
 from datetime import date
 import json
 import os
@@ -26,12 +25,26 @@ from protorpc import remote
 
 from google.appengine.api import urlfetch
 from google.appengine.ext import ndb
-from google.appengine.api import memcache
-from google.appengine.api import taskqueue
 
 from models import *
 
-from utils import getUserId
+import announcements
+import batchjobs
+import converters
+import counters
+import entitycache
+import fieldmask
+import mailoutbox
+import organizers
+import querycache
+import queryplanner
+import registrations
+import requestcontext
+import speakerindex
+import speakers
+import textsearch
+import timetable
+import versionstamp
 
 from settings import *
 
@@ -72,18 +85,60 @@ SESSION_GET_REQUEST_BY_TYPE = endpoints.ResourceContainer(
     message_types.VoidMessage,
     typeOfSession=messages.StringField(1),
     websafeConferenceKey=messages.StringField(2),
+    version=messages.StringField(3),
+)
+
+FEATURED_SPEAKER_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    version=messages.StringField(2),
+)
+
+SESSION_TIME_QUERY_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    date=messages.StringField(2),
+    windowStart=messages.StringField(3),
+    windowEnd=messages.StringField(4),
+    excludedTypes=messages.StringField(5, repeated=True),
+    maxDuration=messages.IntegerField(6),
 )
 
 SESSION_GET_BY_SPEAKER_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     speaker=messages.StringField(1),
+    fields=messages.StringField(2, repeated=True),
+)
 
+SPEAKERS_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageSize=messages.IntegerField(1),
+    pageToken=messages.StringField(2),
 )
 
 SESSION_GET_BY_HIGHLIGHTS_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     highlights=messages.StringField(1),
+    fields=messages.StringField(2, repeated=True),
+    pageSize=messages.IntegerField(3),
+    pageToken=messages.StringField(4),
+)
+
+CONF_SESSIONS_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    fields=messages.StringField(2, repeated=True),
+    version=messages.StringField(3),
+)
 
+FIELDS_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    fields=messages.StringField(1, repeated=True),
+)
+
+TICKET_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    ticketId=messages.StringField(1),
 )
 
 SESSION_REQUEST = endpoints.ResourceContainer(
@@ -96,8 +151,30 @@ SESSION_POST_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1)
 )
 
-MEMCACHE_ANNOUNCEMENTsession_key = "RECENT_ANNOUNCEMENTS"
-MEMCACHE_FEATURED_SPEAKER_KEY = "featured_speaker_"
+SESSIONS_POST_REQUEST = endpoints.ResourceContainer(
+    SessionForms,
+    websafeConferenceKey=messages.StringField(1)
+)
+
+CONF_PAGE_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageSize=messages.IntegerField(1),
+    pageToken=messages.StringField(2),
+)
+
+SEARCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    query=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+)
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# ConferenceForm fields overlaid on the entity after the read
+CONFERENCE_LIVE_FIELDS = ('seatsAvailable',)
+
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -114,37 +191,12 @@ class ConferenceApi(remote.Service):
 
     def _copyProfileToForm(self, prof):
         """Copy relevant fields from Profile to ProfileForm."""
-        # copy relevant fields from Profile to ProfileForm
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(
-                        pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
-        return pf
+        return converters.profileToForm(prof)
 
     def _getProfileFromUser(self):
         """Return user Profile from datastore, creating new one if non-existent."""
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
-        p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
-        if not profile:
-            profile = Profile(
-                key=p_key,
-                displayName=user.nickname(),
-                mainEmail=user.email(),
-                teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED),
-            )
-            profile.put()
-
-        return profile      # return Profile
+        # resolved at most once per request
+        return requestcontext.current().getProfile()
 
     def _doProfile(self, save_request=None):
         """Get user Profile and return to user, possibly updating it first."""
@@ -153,6 +205,7 @@ class ConferenceApi(remote.Service):
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
+            old_name = prof.displayName
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
@@ -163,57 +216,46 @@ class ConferenceApi(remote.Service):
                         # else:
                         #    setattr(prof, field, val)
                         prof.put()
+            # conferences carry a copy of the organiser's name
+            if prof.displayName != old_name:
+                organizers.displayNameChanged(prof)
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
 
     @endpoints.method(message_types.VoidMessage, ProfileForm,
                       path='profile', http_method='GET', name='getProfile')
+    @requestcontext.endpoint
     def getProfile(self, request):
         """Return user profile."""
         return self._doProfile()
 
     @endpoints.method(ProfileMiniForm, ProfileForm,
                       path='profile', http_method='POST', name='saveProfile')
+    @requestcontext.endpoint
     def saveProfile(self, request):
         """Update & return user profile."""
         return self._doProfile(request)
 
 # - - - Conference objects - - - - - - - - - - - - - - - - -
-    def _copyConferenceToForm(self, conf, displayName):
+    def _copyConferenceToForm(self, conf, mask=None):
         """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
-        if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
-        return cf
+        return converters.conferenceToForm(conf, mask)
 
     def _createConferenceObject(self, request):
         """Create or update Conference object, returning ConferenceForm/request."""
         # Check if user is logged in
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        context = requestcontext.current()
+        user = context.requireUser()
+        user_id = context.userId
 
         if not request.name:
             raise endpoints.BadRequestException(
                 "Conference 'name' field required")
 
-        # Copy ConferenceForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name)
-                for field in request.all_fields()}
-        del data['websafeKey']
-        del data['organizerDisplayName']
+        # Copy ConferenceForm/ProtoRPC Message into dict, converting date
+        # strings to Date objects
+        data = converters.conferenceFormToData(request)
 
         # Add default values for missing fields
         for default_value in DEFAULTS:
@@ -221,16 +263,10 @@ class ConferenceApi(remote.Service):
                 data[default_value] = DEFAULTS[default_value]
                 setattr(request, default_value, DEFAULTS[default_value])
 
-        # Convert date strings to Date objects
         if data['startDate']:
-            data['startDate'] = datetime.strptime(
-                data['startDate'][:10], "%Y-%m-%d").date()
             data['month'] = data['startDate'].month
         else:
             data['month'] = 0
-        if data['endDate']:
-            data['endDate'] = datetime.strptime(
-                data['endDate'][:10], "%Y-%m-%d").date()
 
         # set seatsAvailable to be same as maxAttendees on creation
         # both for data model & outbound Message
@@ -246,21 +282,24 @@ class ConferenceApi(remote.Service):
         c_key = ndb.Key(Conference, c_id, parent=p_key)
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
-
-        # create Conference, send email to organizer confirming
-        # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(params={'email': user.email(),
-                              'conferenceInfo': repr(request)},
-                      url='/tasks/send_confirmation_email'
-                      )
+        data['organizerDisplayName'] = request.organizerDisplayName = \
+            context.getProfile().displayName
+
+        # create Conference with its sharded seat counter, send email to
+        # organizer confirming creation & return (modified) ConferenceForm
+        data['seatShards'] = SEAT_SHARDS
+        conf = Conference(**data)
+        ndb.put_multi([conf, textsearch.documentFor(conf)] +
+                      counters.createShards(
+                          c_key, data['seatsAvailable'], data['seatShards']))
+        announcements.seatsChanged(conf, data['seatsAvailable'])
+        mailoutbox.conferenceCreated(conf, user.email())
 
         return request
 
     def _formatFilters(self, filters):
         """Parse, check validity and format user supplied filters."""
         formatted_filters = []
-        inequality_field = None
 
         for f in filters:
             filter_item = {field.name: getattr(f, field.name)
@@ -274,34 +313,29 @@ class ConferenceApi(remote.Service):
                 raise endpoints.BadRequestException(
                     "Filter contains invalid field or operator.")
 
-            # Every operation except "=" is an inequality
-            if filter_item["operator"] != "=":
-                # check if inequality operation has been used in previous filters
-                # disallow the filter if inequality was performed on a different field before
-                # track the field on which the inequality operation is
-                # performed
-                if inequality_field and inequality_field != filter_item["field"]:
+            # numeric fields are compared as integers
+            if filter_item["field"] in ["month", "maxAttendees"]:
+                try:
+                    filter_item["value"] = int(filter_item["value"])
+                except (TypeError, ValueError):
                     raise endpoints.BadRequestException(
-                        "Inequality filter is allowed on only one field.")
-                else:
-                    inequality_field = filter_item["field"]
+                        "Filter value for '%s' must be a number."
+                        % filter_item["field"])
 
+            # inequalities on several fields are fine; queryplanner
+            # applies the ones the datastore can't to the results
             formatted_filters.append(filter_item)
-        return (inequality_field, formatted_filters)
+        return formatted_filters
 
     @ndb.transactional(xg=True)
-    def _conferenceRegistration(self, request, reg=True):
-        """Register or unregister user for selected conference."""
-        retval = None
-        prof = self._getProfileFromUser()  # get user Profile
+    def _registerWithShard(self, p_key, shard_key, web_conf_key, reg):
+        """Move one seat between a SeatShard and the user's Profile.
 
-        # check if conf exists given websafeConfKey
-        # get conference; check that it exists
-        web_conf_key = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=web_conf_key).get()
-        if not conf:
-            raise endpoints.NotFoundException(
-                'No conference found with key: %s' % web_conf_key)
+        Returns True on success, False when unregistering a user that is
+        not registered and None when the shard can no longer serve the
+        request (so the caller can retry on another shard).
+        """
+        prof, shard = ndb.get_multi([p_key, shard_key])
 
         # register
         if reg:
@@ -310,82 +344,201 @@ class ConferenceApi(remote.Service):
                 raise ConflictException(
                     "You have already registered for this conference")
 
-            # check if seats avail
-            if conf.seatsAvailable <= 0:
-                raise ConflictException(
-                    "There are no seats available.")
+            # shard was filled up since candidates were read
+            if shard.seatsTaken >= shard.capacity:
+                return None
 
             # register user, take away one seat
             prof.conferenceKeysToAttend.append(web_conf_key)
-            conf.seatsAvailable -= 1
-            retval = True
+            shard.seatsTaken += 1
 
         # unregister
         else:
             # check if user already registered
-            if web_conf_key in prof.conferenceKeysToAttend:
+            if web_conf_key not in prof.conferenceKeysToAttend:
+                return False
+            if shard.seatsTaken <= 0:
+                return None
 
-                # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(web_conf_key)
-                conf.seatsAvailable += 1
-                retval = True
-            else:
-                retval = False
+            # unregister user, add back one seat
+            prof.conferenceKeysToAttend.remove(web_conf_key)
+            shard.seatsTaken -= 1
 
         # write things back to the datastore & return
-        prof.put()
-        conf.put()
-        return BooleanMessage(data=retval)
+        ndb.put_multi([prof, shard])
+        return True
 
-    def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
-        q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
+    def _moveSeat(self, prof, conf, web_conf_key, reg=True):
+        """Take (reg) or give back a seat of conf for prof.
 
-        # If query exists then sort by inequality filter first
-        if not inequality_filter:
-            q = q.order(Conference.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
+        Returns the result of _registerWithShard on the first shard that
+        can serve the request, or None if none can.
+        """
+        # try shards in random order until one of them can serve the request
+        for shard_key in counters.candidateShards(conf, reg):
+            retval = self._registerWithShard(
+                prof.key, shard_key, web_conf_key, reg)
+            if retval is not None:
+                if retval:
+                    # the cached total moves by the seat just taken/freed
+                    seats = counters.seatsChanged(conf.key, -1 if reg else 1)
+                    if seats is None:
+                        seats = counters.getSeatsAvailable(conf)
+                    announcements.seatsChanged(conf, seats)
+                    if not reg:
+                        # a freed seat may go to the waitlist
+                        registrations.scheduleWorker(web_conf_key)
+                return retval
+        return None
 
-        for filter_item in filters:
-            if filter_item["field"] in ["month", "maxAttendees"]:
-                filter_item["value"] = int(filter_item["value"])
-            formatted_query = ndb.query.FilterNode(
-                filter_item["field"], filter_item["operator"], filter_item["value"])
-            q = q.filter(formatted_query)
-        return q
+    def _conferenceRegistration(self, request, reg=True):
+        """Register or unregister user for selected conference."""
+        prof = self._getProfileFromUser()  # get user Profile
+
+        # check if conf exists given websafeConfKey
+        # get conference; check that it exists
+        web_conf_key = request.websafeConferenceKey
+        conf = entitycache.get(ndb.Key(urlsafe=web_conf_key))
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % web_conf_key)
+
+        if not reg and web_conf_key not in prof.conferenceKeysToAttend:
+            return BooleanMessage(data=False)
+
+        retval = self._moveSeat(prof, conf, web_conf_key, reg)
+        if retval is not None:
+            return BooleanMessage(data=retval)
+
+        if reg:
+            # check if user already registered before reporting sold out
+            if web_conf_key in prof.conferenceKeysToAttend:
+                raise ConflictException(
+                    "You have already registered for this conference")
+            raise ConflictException(
+                "There are no seats available.")
+        return BooleanMessage(data=False)
+
+    def _fetchPage(self, query, request):
+        """Fetch one page of query results, returning (entities, nextPageToken)."""
+        return self._fetchPageAsync(query, request).get_result()
+
+    def _pageSize(self, request):
+        """Return the validated page size of a paged request."""
+        page_size = request.pageSize or DEFAULT_PAGE_SIZE
+        if page_size < 1:
+            raise endpoints.BadRequestException(
+                "'pageSize' must be a positive number.")
+        return min(page_size, MAX_PAGE_SIZE)
+
+    def _parseCursor(self, page_token, urlsafe):
+        """Return the Cursor of a page token, raising BadRequest if invalid."""
+        try:
+            return ndb.Cursor(urlsafe=urlsafe)
+        except Exception:
+            raise endpoints.BadRequestException(
+                "Invalid 'pageToken': %s" % page_token)
+
+    @ndb.tasklet
+    def _fetchPageAsync(self, query, request, plan=fieldmask.FULL_READ):
+        """Tasklet version of _fetchPage."""
+        page_size = self._pageSize(request)
+        start_cursor = None
+        if request.pageToken:
+            start_cursor = self._parseCursor(
+                request.pageToken, request.pageToken)
+
+        # fetch_page reads the page exactly once; callers must reuse the list
+        entities, next_cursor, more = yield fieldmask.fetchAsync(
+            query, plan, page_size, start_cursor)
+        next_token = next_cursor.urlsafe() if (more and next_cursor) else None
+        raise ndb.Return((entities, next_token))
+
+    @ndb.tasklet
+    def _conferenceFormsAsync(self, conferences, mask=None):
+        """Return ConferenceForm objects for conferences with live seats.
+
+        Organiser names are stored on the conferences; seat counters are
+        only read if the mask asks for them.
+        """
+        if fieldmask.wants(mask, 'seatsAvailable'):
+            yield counters.applySeatsAvailableAsync(conferences)
+        raise ndb.Return(
+            [self._copyConferenceToForm(conf, mask) for conf in conferences])
+
+    def _getQuery(self, request, filters, plan_name=None):
+        """Return the query plan of filters formatted by _formatFilters."""
+        try:
+            return queryplanner.plan(filters, plan_name)
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "Invalid 'pageToken': %s" % request.pageToken)
+
+    @ndb.tasklet
+    def _plannedPageAsync(self, request, filters, read_plan):
+        """Fetch one page of a conference query through the query planner.
+
+        Page tokens are '<plan name>:<cursor>', so later pages keep the
+        plan of the first one.
+        """
+        page_size = self._pageSize(request)
+        plan_name, cursor = None, None
+        if request.pageToken:
+            plan_name, _, urlsafe = request.pageToken.partition(':')
+            cursor = self._parseCursor(request.pageToken, urlsafe)
+        plan = self._getQuery(request, filters, plan_name)
+
+        entities, next_cursor = yield queryplanner.fetchPageAsync(
+            plan, page_size, cursor, read_plan)
+        next_token = None
+        if next_cursor:
+            next_token = '%s:%s' % (plan.name, next_cursor.urlsafe())
+        raise ndb.Return((entities, next_token))
 
     @endpoints.method(ConferenceQueryForms, ConferenceForms,
                       path='queryConferences',
                       http_method='POST',
                       name='queryConferences')
+    @requestcontext.endpoint
     def queryConferences(self, request):
-        """Query for conferences."""
-        conferences = self._getQuery(request)
-
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId))
-                      for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        """Query for conferences, optionally returning only the masked fields."""
+        return self._queryConferencesAsync(request).get_result()
+
+    @ndb.tasklet
+    def _queryConferencesAsync(self, request):
+        """Fetch a page of conferences, then their organisers and seats."""
+        filters = self._formatFilters(request.filters)
+        mask = fieldmask.parseMask(request.fields, ConferenceForm)
+        plan = fieldmask.readPlan(
+            Conference, mask, 'websafeKey', CONFERENCE_LIVE_FIELDS)
+
+        # popular filter combinations are served from the query cache
+        cache_key = querycache.queryKey(
+            filters, request.pageSize, request.pageToken)
+        generation, cached = querycache.lookup(cache_key)
+        if cached:
+            conf_keys, next_token = cached
+            if plan == fieldmask.KEYS_ONLY_READ:
+                conferences = fieldmask.keyStubs(Conference, conf_keys)
+            else:
+                conferences = yield entitycache.getMultiAsync(conf_keys)
+                conferences = [conf for conf in conferences if conf]
+        else:
+            conferences, next_token = yield self._plannedPageAsync(
+                request, filters, plan)
+            querycache.store(cache_key, generation,
+                             [conf.key for conf in conferences], next_token)
 
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        items = yield self._conferenceFormsAsync(conferences, mask)
 
         # return individual ConferenceForm object per Conference
-        return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in
-                   conferences]
-        )
+        raise ndb.Return(ConferenceForms(items=items, nextPageToken=next_token))
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(CONF_PAGE_REQUEST, ConferenceForms,
                       path='filterPlayground',
                       http_method='GET',
                       name='filterPlayground')
+    @requestcontext.endpoint
     def filterPlayground(self, request):
         """Query for conferences filter by city."""
         q = Conference.query()
@@ -394,16 +547,20 @@ class ConferenceApi(remote.Service):
         value = "London"
         # Uses FilterNode method
         f = ndb.query.FilterNode(field, operator, value)
-        q = q.filter(f)
+        q = q.filter(f).order(Conference.name)
+        conferences, next_token = self._fetchPage(q, request)
+        counters.applySeatsAvailable(conferences)
         # return individual ConferenceForm object per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, "") for conf in q]
+            items=[self._copyConferenceToForm(conf) for conf in conferences],
+            nextPageToken=next_token
         )
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(CONF_PAGE_REQUEST, ConferenceForms,
                       path='getSmallConferences',
                       http_method='GET',
                       name='getSmallConferences')
+    @requestcontext.endpoint
     def getSmallConferences(self, request):
         """Query for conferences filter by max attendees of 50 or fewer."""
         q = Conference.query()
@@ -412,249 +569,497 @@ class ConferenceApi(remote.Service):
         value = 51
         # Uses FilterNode method
         f = ndb.query.FilterNode(field, operator, value)
-        q = q.filter(f)
+        q = q.filter(f).order(Conference.maxAttendees).order(Conference.name)
+        conferences, next_token = self._fetchPage(q, request)
+        counters.applySeatsAvailable(conferences)
         # return individual ConferenceForm object per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, "") for conf in q]
+            items=[self._copyConferenceToForm(conf) for conf in conferences],
+            nextPageToken=next_token
         )
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
                       http_method='POST', name='createConference')
+    @requestcontext.endpoint
     def createConference(self, request):
         """Create new conference."""
         return self._createConferenceObject(request)
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms, path='getConferencesCreated',
+    @endpoints.method(CONF_PAGE_REQUEST, ConferenceForms, path='getConferencesCreated',
                       http_method='POST', name='getConferencesCreated')
+    @requestcontext.endpoint
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
-        p_key = ndb.Key(Profile, user_id)
-        conferences = Conference.query(ancestor=p_key)
-        prof = ndb.Key(Profile, user_id).get()
-        displayName = getattr(prof, 'displayName')
+        p_key = requestcontext.current().profileKey
+        conferences, next_token = self._fetchPage(
+            Conference.query(ancestor=p_key).order(Conference.name), request)
+        counters.applySeatsAvailable(conferences)
 
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, displayName) for conf in conferences])
+        return ConferenceForms(
+            items=[self._copyConferenceToForm(conf) for conf in conferences],
+            nextPageToken=next_token
+        )
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
                       path='conference/{websafeConferenceKey}',
                       http_method='POST', name='registerForConference')
+    @requestcontext.endpoint
     def registerForConference(self, request):
         """Register user for selected conference."""
         return self._conferenceRegistration(request)
 
+    def _copyTicketToForm(self, ticket):
+        """Copy a RegistrationTicket to a RegistrationTicketForm."""
+        return RegistrationTicketForm(
+            ticketId=ticket.key.id(),
+            websafeConferenceKey=ticket.conferenceKey,
+            status=ticket.status,
+            created=str(ticket.created),
+            updated=str(ticket.updated))
+
+    @endpoints.method(CONF_GET_REQUEST, RegistrationTicketForm,
+                      path='conference/{websafeConferenceKey}/queueRegistration',
+                      http_method='POST', name='queueRegistration')
+    @requestcontext.endpoint
+    def queueRegistration(self, request):
+        """Queue a registration for a conference, returning a ticket to poll.
+
+        Seats are assigned in batches, first come first served; when the
+        conference is sold out the ticket is waitlisted.
+        """
+        prof = self._getProfileFromUser()
+        web_conf_key = request.websafeConferenceKey
+        conf = entitycache.get(ndb.Key(urlsafe=web_conf_key))
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % web_conf_key)
+        if web_conf_key in prof.conferenceKeysToAttend:
+            raise ConflictException(
+                "You have already registered for this conference")
+        ticket = registrations.enqueue(prof.key.id(), web_conf_key)
+        return self._copyTicketToForm(ticket)
+
+    @endpoints.method(TICKET_GET_REQUEST, RegistrationTicketForm,
+                      path='registrationTicket/{ticketId}',
+                      http_method='GET', name='getRegistrationTicket')
+    @requestcontext.endpoint
+    def getRegistrationTicket(self, request):
+        """Return the status of one of the user's registration tickets."""
+        user_id = requestcontext.current().userId
+        ticket = registrations.getTicket(request.ticketId)
+        if not ticket or ticket.userId != user_id:
+            raise endpoints.NotFoundException(
+                'No registration ticket found with ID: %s' % request.ticketId)
+        return self._copyTicketToForm(ticket)
+
     @endpoints.method(SESSION_POST_REQUEST, SessionForm,
                       path='conference/{websafeConferenceKey}/newSession',
                       http_method='POST', name='createSession')
+    @requestcontext.endpoint
     def createSession(self, request):
         """Create a session in a given conference; open only to the organizer of this conference."""
         return self._createSessionObject(request)
 
-    @endpoints.method(CONF_GET_REQUEST, SessionForms,
+    @endpoints.method(SESSIONS_POST_REQUEST, SessionForms,
+                      path='conference/{websafeConferenceKey}/newSessions',
+                      http_method='POST', name='createSessions')
+    @requestcontext.endpoint
+    def createSessions(self, request):
+        """Create several sessions in a given conference at once; open only to the organizer of this conference."""
+        return self._createSessionObjects(request)
+
+    @endpoints.method(CONF_SESSIONS_REQUEST, SessionForms,
                       path='conference/{websafeConferenceKey}/sessions',
                       http_method='GET', name='getConferenceSessions')
+    @requestcontext.endpoint
     def getConferenceSessions(self, request):
-        """Returns all sessions within a given conference."""
-        # Get the conference key
-        web_conf_key = request.websafeConferenceKey
-        # Get the conference with the given target key
-        conf = ndb.Key(urlsafe=web_conf_key).get()
-        # Check conference existance
+        """Returns all sessions within a given conference.
+
+        Answers with notModified and no items if the client's ETag (sent as
+        If-None-Match or 'version') is current.
+        """
+        conf_key, etag, not_modified = self._conditionalRead(
+            request, 'getConferenceSessions', *sorted(request.fields))
+        if not_modified:
+            return SessionForms(etag=etag, notModified=True)
+        # served from the conference's timetable, in date/startTime order
+        forms = timetable.getSessionForms(
+            conf_key, mask=fieldmask.parseMask(request.fields, SessionForm))
+        if forms is None:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' %
+                request.websafeConferenceKey)
+        forms.etag = etag
+        return forms
+
+    def _requestETag(self, request):
+        """Return the ETag sent by the client (version or If-None-Match)."""
+        if request.version:
+            return request.version
+        headers = getattr(getattr(self, 'request_state', None),
+                          'headers', None)
+        return headers.get('If-None-Match') if headers else None
+
+    def _conditionalRead(self, request, *parts):
+        """Check a conference read against the conference's version stamp.
+
+        Returns (conference key, current ETag, True if the client's ETag
+        matches). Only memcache is consulted.
+        """
+        try:
+            conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        except Exception:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' %
+                request.websafeConferenceKey)
+        etag = versionstamp.etag(versionstamp.getVersion(conf_key), *parts)
+        return conf_key, etag, versionstamp.matches(
+            self._requestETag(request), etag)
+
+    def _parseQueryValue(self, parse, name, value):
+        """Parse a request value, raising BadRequest if it is malformed."""
+        try:
+            return parse(value)
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "Invalid '%s': %s" % (name, value))
+
+    def _querySessionsByTime(self, conf_key, request):
+        """Return sessions of conf_key matching a SESSION_TIME_QUERY_REQUEST."""
+        q = Session.query(ancestor=conf_key)
+        if request.date:
+            q = q.filter(Session.date == self._parseQueryValue(
+                converters.parseDate, 'date', request.date))
+
+        # minutes of the day; sessions overlapping [start, end) match
+        windowed = bool(request.windowStart or request.windowEnd)
+        start, end = 0, 24 * 60
+        if request.windowStart:
+            start = self._parseQueryValue(
+                converters.parseTime, 'windowStart', request.windowStart)
+            start = start.hour * 60 + start.minute
+        if request.windowEnd:
+            end = self._parseQueryValue(
+                converters.parseTime, 'windowEnd', request.windowEnd)
+            end = end.hour * 60 + end.minute
+        if end <= start:
+            raise endpoints.BadRequestException(
+                "'windowEnd' must be after 'windowStart'.")
+        if windowed:
+            # only the hour buckets of the window are read; the single
+            # inequality is on the interval index, everything else is
+            # checked on the narrowed down sessions
+            q = q.filter(Session.timeBuckets >= start // 60,
+                         Session.timeBuckets <= (end - 1) // 60)
+
+        excluded = set(request.excludedTypes)
+        sessions = []
+        for session in q:
+            if excluded.intersection(session.typeOfSession):
+                continue
+            if request.maxDuration is not None and (
+                    session.duration is None or
+                    session.duration > request.maxDuration):
+                continue
+            if windowed:
+                s_start, s_end = sessionMinutes(
+                    session.startTime, session.duration)
+                if s_start >= end or s_end <= start:
+                    continue
+            sessions.append(session)
+        return sessions
+
+    @endpoints.method(SESSION_TIME_QUERY_REQUEST, SessionForms,
+                      path='conference/{websafeConferenceKey}/sessionsByTime',
+                      http_method='GET', name='querySessionsByTime')
+    @requestcontext.endpoint
+    def querySessionsByTime(self, request):
+        """Return sessions of a conference overlapping a time window.
+
+        Optionally restricted to a date, excluding session types and
+        capping the duration (e.g. non-workshops before 19:00).
+        """
+        conf = entitycache.get(ndb.Key(urlsafe=request.websafeConferenceKey))
         if not conf:
             raise endpoints.NotFoundException(
-                'No conference found with key: %s' % web_conf_key)
-        # Create ancestor query
-        sessions = Session.query(ancestor=conf.key)
-        return SessionForms(items=[self._copySessionToForm(session) for session in sessions])
+                'No conference found with key: %s' %
+                request.websafeConferenceKey)
+        sessions = self._querySessionsByTime(conf.key, request)
+        return SessionForms(
+            items=[self._copySessionToForm(session) for session in sessions])
 
     @endpoints.method(SESSION_GET_BY_HIGHLIGHTS_REQUEST, SessionForms,
                       path='/sessions/highlights/{highlights}',
                       http_method='GET', name='getSessionsByHighlights')
+    @requestcontext.endpoint
     def getSessionsByHighlights(self, request):
-        """Given a specified highlight, return all sessions with this specific highlight, across all conferences."""
-        sessions = Session.query()
-        sessions = sessions.filter(Session.highlights == request.highlights)
+        """Given a specified highlight, return the best matching sessions across all conferences."""
+        mask = fieldmask.parseMask(request.fields, SessionForm)
+        session_keys, next_token = self._searchKeys(
+            'Session', request.highlights, request)
+        if fieldmask.readPlan(Session, mask, 'sessionSafeKey') == \
+                fieldmask.KEYS_ONLY_READ:
+            sessions = fieldmask.keyStubs(Session, session_keys)
+        else:
+            sessions = [s for s in entitycache.getMulti(session_keys) if s]
         # return set of SessionForm objects
-        return SessionForms(items=[self._copySessionToForm(session) for session in sessions])
+        return SessionForms(items=[self._copySessionToForm(session, mask)
+                                   for session in sessions],
+                            nextPageToken=next_token)
+
+    def _searchKeys(self, kind, query_string, request):
+        """Run a paged search, returning (entity keys, nextPageToken)."""
+        try:
+            return textsearch.search(kind, query_string,
+                                     self._pageSize(request),
+                                     request.pageToken)
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "Invalid 'pageToken': %s" % request.pageToken)
+
+    def _searchPage(self, kind, request):
+        """Run a search request, returning (entities, nextPageToken)."""
+        keys, next_token = self._searchKeys(kind, request.query, request)
+        entities = [e for e in entitycache.getMulti(keys) if e]
+        return entities, next_token
+
+    @endpoints.method(SEARCH_REQUEST, SessionForms,
+                      path='search/sessions',
+                      http_method='GET', name='searchSessions')
+    @requestcontext.endpoint
+    def searchSessions(self, request):
+        """Full-text search over session names, highlights and speakers.
+
+        All terms must match; a term ending in '*' matches as a prefix.
+        """
+        sessions, next_token = self._searchPage('Session', request)
+        return SessionForms(
+            items=[self._copySessionToForm(session) for session in sessions],
+            nextPageToken=next_token)
+
+    @endpoints.method(SEARCH_REQUEST, ConferenceForms,
+                      path='search/conferences',
+                      http_method='GET', name='searchConferences')
+    @requestcontext.endpoint
+    def searchConferences(self, request):
+        """Full-text search over conference names, descriptions and topics.
+
+        All terms must match; a term ending in '*' matches as a prefix.
+        """
+        conferences, next_token = self._searchPage('Conference', request)
+        items = self._conferenceFormsAsync(conferences).get_result()
+        return ConferenceForms(items=items, nextPageToken=next_token)
 
     @endpoints.method(SESSION_GET_REQUEST_BY_TYPE, SessionForms,
                       path='conference/{websafeConferenceKey}/sessions/{typeOfSession}',
                       http_method='GET', name='getConferenceSessionsByType')
+    @requestcontext.endpoint
     def getConferenceSessionsByType(self, request):
         """Given a conference, return all sessions of a specified type (e.g. lecture, keynote, workshop)."""
-        # get the conference key
-        web_conf_key = request.websafeConferenceKey
-        # get the type of session we want
-        typeOfSession = request.typeOfSession
-        # fetch the conference with the target key
-        conf = ndb.Key(urlsafe=web_conf_key).get()
-        # check whether the conference exists or not
-        if not conf:
+        conf_key, etag, not_modified = self._conditionalRead(
+            request, 'getConferenceSessionsByType', request.typeOfSession)
+        if not_modified:
+            return SessionForms(etag=etag, notModified=True)
+        # served from the conference's timetable, in date/startTime order
+        forms = timetable.getSessionForms(conf_key, request.typeOfSession)
+        if forms is None:
             raise endpoints.NotFoundException(
-                'No conference found with key: %s' % web_conf_key)
-        # create ancestor query for all key matches for this conference and
-        # type is what we want
-        sessions = Session.query(ancestor=conf.key)
-        sessions = sessions.filter(
-            Session.typeOfSession == typeOfSession)
-        # return set of SessionForm objects per Session
-        return SessionForms(items=[self._copySessionToForm(session) for session in sessions])
+                'No conference found with key: %s' %
+                request.websafeConferenceKey)
+        forms.etag = etag
+        return forms
 
     @endpoints.method(SESSION_GET_BY_SPEAKER_REQUEST, SessionForms,
                       path='/sessions/speaker/{speaker}',
                       http_method='GET', name='getSessionsBySpeaker')
+    @requestcontext.endpoint
     def getSessionsBySpeaker(self, request):
-        """Given a speaker, return all sessions given by this particular speaker, across all conferences."""
-        sessions = Session.query()
-        sessions = sessions.filter(Session.speaker == request.speaker)
-        # return set of SessionForm objects
-        return SessionForms(items=[self._copySessionToForm(session) for session in sessions])
+        """Given a speaker, return all sessions given by this particular speaker, across all conferences.
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+        The speaker name is matched ignoring case, accents, punctuation and
+        spacing.
+        """
+        mask = fieldmask.parseMask(request.fields, SessionForm)
+        session_keys = speakers.getSessionKeys(request.speaker)
+        if fieldmask.readPlan(Session, mask, 'sessionSafeKey') == \
+                fieldmask.KEYS_ONLY_READ:
+            # the Speaker already holds everything asked for
+            sessions = fieldmask.keyStubs(Session, session_keys)
+        else:
+            sessions = [session for session in
+                        entitycache.getMulti(session_keys) if session]
+        return SessionForms(
+            items=[self._copySessionToForm(session, mask)
+                   for session in sessions])
+
+    @endpoints.method(SPEAKERS_REQUEST, SpeakerForms,
+                      path='speakers',
+                      http_method='GET', name='getSpeakers')
+    @requestcontext.endpoint
+    def getSpeakers(self, request):
+        """List speakers across all conferences, most sessions first."""
+        speaker_list, next_token = self._fetchPageAsync(
+            Speaker.query().order(-Speaker.sessionCount),
+            request).get_result()
+        return SpeakerForms(
+            items=[SpeakerForm(name=speaker.name, aliases=speaker.aliases,
+                               sessionCount=speaker.sessionCount)
+                   for speaker in speaker_list],
+            nextPageToken=next_token)
+
+    @endpoints.method(FIELDS_REQUEST, ConferenceForms,
                       path='conferences/attending',
                       http_method='GET', name='getConferencesToAttend')
+    @requestcontext.endpoint
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
         prof = self._getProfileFromUser()  # get user Profile
+        mask = fieldmask.parseMask(request.fields, ConferenceForm)
+        return self._conferencesToAttendAsync(prof, mask).get_result()
+
+    @ndb.tasklet
+    def _conferencesToAttendAsync(self, prof, mask=None):
+        """Fetch the conferences of prof, then their organisers and seats."""
         conf_keys = [ndb.Key(urlsafe=web_conf_key)
                      for web_conf_key in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
-
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId)
-                      for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        if fieldmask.readPlan(Conference, mask, 'websafeKey') == \
+                fieldmask.KEYS_ONLY_READ:
+            # the profile already holds everything asked for
+            conferences = fieldmask.keyStubs(Conference, conf_keys)
+        else:
+            conferences = yield entitycache.getMultiAsync(conf_keys)
+            conferences = [conf for conf in conferences if conf]
+        items = yield self._conferenceFormsAsync(conferences, mask)
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])
-                                      for conf in conferences]
-                               )
+        raise ndb.Return(ConferenceForms(items=items))
 
-    @endpoints.method(message_types.VoidMessage, BooleanMessage,
+    @endpoints.method(message_types.VoidMessage, StringMessage,
                       path='clearAllData', http_method='GET',
                       name='clearAllData')
+    @requestcontext.endpoint
     def clearAllData(self, request):
-        """Clear all the data saved."""
-        ndb.delete_multi(Session.query().fetch(keys_only=True))
-        ndb.delete_multi(Conference.query().fetch(keys_only=True))
-        profiles = Profile.query()
-        for profile in profiles:
-            profile.conferenceKeysToAttend = []
-            profile.sessionKeysInWishlist = []
-            profile.put()
-        return BooleanMessage(data=True)
+        """Start clearing all the data saved; returns the batch job ID.
+
+        Progress can be polled at /admin/jobs/status?job=<ID>.
+        """
+        job_key = batchjobs.startJob('clear_all_data')
+        return StringMessage(data=str(job_key.id()))
 # - - - Session Objects - - - - - - - - - - - - - - - - -
 
-    def _copySessionToForm(self, session):
+    def _copySessionToForm(self, session, mask=None):
         """Copy relevant fields from Session to SessionForm."""
-        session_objects = SessionForm()
-        for field in session_objects.all_fields():
-            if hasattr(session, field.name):
-                if field.name.endswith('date') or field.name.endswith('startTime'):
-                    setattr(session_objects, field.name,
-                            str(getattr(session, field.name)))
-                else:
-                    setattr(session_objects, field.name,
-                            getattr(session, field.name))
-            elif field.name == "sessionSafeKey":
-                setattr(session_objects, field.name, session.key.urlsafe())
-            elif field.name == "websafeConferenceKey":
-                setattr(sf, field.name, session.key.parent().urlsafe())
-        session_objects.check_initialized()
-        return session_objects
+        return converters.sessionToForm(session, mask)
 
-    def _createSessionObject(self, request):
-        """Create or update Conference object, returning SessionForm/request."""
+    def _getConferenceAsOrganizer(self, web_conf_key):
+        """Return the Conference for web_conf_key if the user organizes it."""
         # Check user authenetication
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user_id = requestcontext.current().userId
 
-        if not request.name:
-            raise endpoints.BadRequestException(
-                "Session 'name' field required")
-
-        # Get conference key
-        web_conf_key = request.websafeConferenceKey
         # Get conference object
-        c_key = ndb.Key(urlsafe=web_conf_key)
-        conf = c_key.get()
+        conf = entitycache.get(ndb.Key(urlsafe=web_conf_key))
         # Check that conference exists if not then raise error
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % web_conf_key)
         # Check that the user is the creator of the conference
-        if conf.organizerUserId != getUserId(endpoints.get_current_user()):
+        if conf.organizerUserId != user_id:
             raise endpoints.ForbiddenException(
                 'You must be the organizer to create a session.')
+        return conf
+
+    def _sessionDataFromForm(self, form):
+        """Copy a SessionForm into a dict of Session properties."""
+        if not form.name:
+            raise endpoints.BadRequestException(
+                "Session 'name' field required")
+        if not form.speaker:
+            raise endpoints.BadRequestException(
+                "Session 'speaker' field required")
+
+        # Copy the SessionForm/ProtoRPC Message into dict, converting date
+        # and time strings to Date objects
+        return converters.sessionFormToData(form)
+
+    @ndb.transactional
+    def _storeSessions(self, conf_key, sessions):
+        """Write sessions, updating the conference's speaker index and
+        timetable."""
+        ndb.put_multi(sessions +
+                      [textsearch.documentFor(session) for session in sessions])
+        speakerindex.addSessions(conf_key, sessions)
+        timetable.addSessions(conf_key, sessions)
+        speakers.sessionsCreated(sessions)
+        versionstamp.bump(conf_key)
+
+    def _createSessionObject(self, request):
+        """Create or update Conference object, returning SessionForm/request."""
+        if not request.name:
+            raise endpoints.BadRequestException(
+                "Session 'name' field required")
+
+        # Get conference key
+        web_conf_key = request.websafeConferenceKey
+        conf = self._getConferenceAsOrganizer(web_conf_key)
+        data = self._sessionDataFromForm(request)
 
-        # Copy the SessionForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name)
-                for field in request.all_fields()}
-        # Convert date and time from strings to Date objects;
-        if data['date']:
-            data['date'] = datetime.strptime(
-                data['date'][:10], "%Y-%m-%d").date()
-        if data['startTime']:
-            data['startTime'] = datetime.strptime(
-                data['startTime'][:10],  "%H, %M").time()
         # Create new Session ID with Conference key as the parent
-        session_id = Session.allocate_ids(size=1, parent=c_key)[0]
+        session_id = Session.allocate_ids(size=1, parent=conf.key)[0]
         # Make Session key from ID
-        session_key = ndb.Key(Session, session_id, parent=c_key)
-        data['key'] = session_key
-        data['websafeConferenceKey'] = web_conf_key
-        del data['sessionSafeKey']
-        del data['websafeConferenceKey']
-
-        # Save session into database
-        Session(**data).put()
-        # Taskque for featuredSpeaker endpoint
-        # check for featured speaker in conference:
-        taskqueue.add(params={'speaker': data['speaker'],
-                              'wsck': web_conf_key
-                              },
-                      url='/tasks/check_featured_speaker')
-
-        session = session_key.get()
+        data['key'] = ndb.Key(Session, session_id, parent=conf.key)
+
+        # Save session into database, updating the featured speaker
+        session = Session(**data)
+        self._storeSessions(conf.key, [session])
+
         return self._copySessionToForm(session)
 
+    def _createSessionObjects(self, request):
+        """Create several sessions of one Conference, returning SessionForms."""
+        web_conf_key = request.websafeConferenceKey
+        conf = self._getConferenceAsOrganizer(web_conf_key)
+        if not request.items:
+            return SessionForms(items=[])
+
+        # validate everything before allocating IDs or writing anything
+        session_data = [self._sessionDataFromForm(form)
+                        for form in request.items]
+
+        # allocate one contiguous ID range for the whole batch
+        first, last = Session.allocate_ids(
+            size=len(session_data), parent=conf.key)
+        sessions = []
+        for session_id, data in zip(range(first, last + 1), session_data):
+            data['key'] = ndb.Key(Session, session_id, parent=conf.key)
+            sessions.append(Session(**data))
+
+        # Save sessions into database, updating the featured speaker once
+        self._storeSessions(conf.key, sessions)
+
+        return SessionForms(
+            items=[self._copySessionToForm(session) for session in sessions])
+
     @endpoints.method(SESSION_REQUEST, SessionForm,
                       path="addSessionToWishlist",
                       http_method="POST", name='addSessionToWishlist')
+    @requestcontext.endpoint
     def addSessionToWishlist(self, request):
         """Add the session to the user's list of sessions they are interested in attending"""
         # Get the session key
         sessionKey = request.sessionKey
         # Get the session object
-        session = ndb.Key(urlsafe=sessionKey).get()
+        session = entitycache.get(ndb.Key(urlsafe=sessionKey))
         # Check that session exists or not
         if not session:
             raise endpoints.NotFoundException(
                 'No session found with key: %s' % sessionKey)
 
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-
         profile = self._getProfileFromUser()
         if not profile:
             raise endpoints.BadRequestException(
                 'Profile does not exist for user')
         # Check if key and Session match
-        if not type(ndb.Key(urlsafe=sessionKey).get()) == Session:
+        if not isinstance(session, Session):
             raise endpoints.NotFoundException(
                 'This key is not a Session instance')
         # Add the session to wishlist
@@ -670,26 +1075,24 @@ class ConferenceApi(remote.Service):
     @endpoints.method(SESSION_REQUEST, BooleanMessage,
                       path="deleteSessionInWishlist",
                       http_method='DELETE', name='deleteSessionInWishlist')
+    @requestcontext.endpoint
     def deleteSessionInWishlist(self, request):
         """Delete session in user's wishlist"""
         # Get the session key
         sessionKey = request.sessionKey
         # Get the session object
-        session = ndb.Key(urlsafe=sessionKey).get()
+        session = entitycache.get(ndb.Key(urlsafe=sessionKey))
         # Check that session exists or not
         if not session:
             raise endpoints.NotFoundException(
                 'No session found with key: %s' % sessionKey)
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
         # Get profile
         profile = self._getProfileFromUser()
         if not profile:
             raise endpoints.BadRequestException(
                 'Profile does not exist for user')
         # Check if key and Session match
-        if not type(ndb.Key(urlsafe=sessionKey).get()) == Session:
+        if not isinstance(session, Session):
             raise endpoints.NotFoundException(
                 'This key is not a Session instance')
         # Delete session from wishlist
@@ -705,6 +1108,7 @@ class ConferenceApi(remote.Service):
     @endpoints.method(message_types.VoidMessage, SessionForms,
                       path='getSessionsInWishlist', http_method='GET',
                       name='getSessionsInWishlist')
+    @requestcontext.endpoint
     def getSessionsInWishlist(self, request):
         """Query for all the sessions in a conference that the user is interested in."""
         profile = self._getProfileFromUser()
@@ -714,72 +1118,123 @@ class ConferenceApi(remote.Service):
         # Get all of the session keys in db
         sessionkeys = [ndb.Key(urlsafe=sessionkey)
                        for sessionkey in profile.sessionKeysInWishlist]
-        sessions = ndb.get_multi(sessionkeys)
+        sessions = entitycache.getMulti(sessionkeys)
         # Return set of SessionForm objects per conference
-        return SessionForms(items=[self._copySessionToForm(session) for session in sessions])
+        return SessionForms(items=[self._copySessionToForm(session)
+                                   for session in sessions if session])
 
 # - - - Featured Speaker - - - - - - - - - - - - - - - - -
-    @endpoints.method(CONF_GET_REQUEST, StringMessage,
+    @endpoints.method(FEATURED_SPEAKER_REQUEST, StringMessage,
                       path='featuredSpeaker',
                       http_method='GET',
                       name='getFeaturedSpeaker')
+    @requestcontext.endpoint
     def getFeaturedSpeaker(self, request):
         """Returns featured speaker and the sessions he's partaking in from
         memcache"""
+        conf_key, etag, not_modified = self._conditionalRead(
+            request, 'getFeaturedSpeaker')
+        if not_modified:
+            return StringMessage(data="", etag=etag, notModified=True)
 
         # get conference; check that it exists
         wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
+        conf = entitycache.get(ndb.Key(urlsafe=wsck))
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
 
-        # create memcache key based on conf key:
-        memcache_key = MEMCACHE_FEATURED_SPEAKER_KEY + str(wsck)
-
-        # try to find entry in memcache:
-        output_ = memcache.get(memcache_key)
+        # read featured speaker from memcache, falling back to the index
+        output_ = speakerindex.getFeaturedSpeaker(conf.key)
         if output_:
-            return StringMessage(data=memcache.get(memcache_key))
+            return StringMessage(data=output_, etag=etag)
         else:
             return StringMessage(
-                data="There are no featured speakers for this conference.")
+                data="There are no featured speakers for this conference.",
+                etag=etag)
 
 
 # - - - Annoucement - - - - - - - - - - - - - - - - -
     @staticmethod
     def _cacheAnnouncement():
-        """Create Announcement and assign to memcache
+        """Reconcile the almost sold out conferences and return Announcement
         """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
-            # Send to memcache when conferences are almost sold out
-            announcement = '%s %s' % (
-                'Act soon! The following conferences '
-                'are almost sold out:',
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTsession_key, announcement)
-        else:
-            # Delete the memcache announcements entry when conference is not
-            # sold out
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTsession_key)
-
-        return announcement
+        return announcements.reconcile()
 
     @endpoints.method(message_types.VoidMessage, StringMessage,
                       path='conference/announcement/get',
                       http_method='GET', name='getAnnouncement')
+    @requestcontext.endpoint
     def getAnnouncement(self, request):
-        """Get Announcement from memcache."""
-        announcement = memcache.get(MEMCACHE_ANNOUNCEMENTsession_key)
-        if not announcement:
-            announcement = ""
-        return StringMessage(data=announcement)
+        """Get Announcement from memcache, rebuilding it if evicted."""
+        return StringMessage(data=announcements.getAnnouncement())
+
+# - - - Batch jobs - - - - - - - - - - - - - - - - - - - -
+
+def _resetProfiles(profiles):
+    """Clear registrations and wishlists of a chunk of profiles."""
+    for profile in profiles:
+        profile.conferenceKeysToAttend = []
+        profile.sessionKeysInWishlist = []
+    return profiles, []
+
+
+def _backfillSeatShards(conferences):
+    """Create sharded seat counters for conferences that lack them."""
+    for conf in conferences:
+        counters.ensureShards(conf)
+    return [], []
+
+
+def _backfillSpeakerIndex(conf_keys):
+    """Build the speaker index of conferences that lack one."""
+    for conf_key in conf_keys:
+        speakerindex.ensureIndex(conf_key)
+    return [], []
+
+
+def _backfillSearchIndex(entities):
+    """(Re)build the search documents of a chunk of sessions/conferences."""
+    return [textsearch.documentFor(entity) for entity in entities], []
+
+
+def _backfillTimeBuckets(sessions):
+    """Rewrite sessions so their computed time buckets get indexed."""
+    return sessions, []
+
+
+batchjobs.registerJob('clear_all_data', [
+    (SearchDocument, batchjobs.deleteKeys, True),
+    (Session, batchjobs.deleteKeys, True),
+    (Conference, batchjobs.deleteKeys, True),
+    (SeatShard, batchjobs.deleteKeys, True),
+    (SpeakerIndex, batchjobs.deleteKeys, True),
+    (Speaker, batchjobs.deleteKeys, True),
+    (Timetable, batchjobs.deleteKeys, True),
+    (AlmostSoldOut, batchjobs.deleteKeys, True),
+    (RegistrationTicket, batchjobs.deleteKeys, True),
+    (OutboxMail, batchjobs.deleteKeys, True),
+    (Profile, _resetProfiles, False),
+])
+batchjobs.registerJob('backfill_seat_shards', [
+    (Conference, _backfillSeatShards, False),
+])
+batchjobs.registerJob('backfill_speaker_index', [
+    (Conference, _backfillSpeakerIndex, True),
+])
+batchjobs.registerJob('backfill_speakers', [
+    (Session, speakers.backfillSpeakers, False),
+])
+batchjobs.registerJob('backfill_session_time_buckets', [
+    (Session, _backfillTimeBuckets, False),
+])
+batchjobs.registerJob('backfill_organizer_names', [
+    (Conference, organizers.backfillOrganizerNames, False),
+])
+batchjobs.registerJob('backfill_search_index', [
+    (Conference, _backfillSearchIndex, False),
+    (Session, _backfillSearchIndex, False),
+])
 
 # registers API
 api = endpoints.api_server([ConferenceApi])
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""converters.py
+
+Entity <-> ProtoRPC message converters, built once per (model, message) pair
+at import time.
+
+Matching fields and their date/time/enum conversion are worked out when the
+converter is created, so converting an entity is a straight run of
+assignments instead of inspecting every message field with hasattr/getattr
+and string suffix checks on each call.
+
+"""
+
+from datetime import datetime
+
+from google.appengine.ext import ndb
+from protorpc import messages
+
+from models import Conference
+from models import ConferenceForm
+from models import Profile
+from models import ProfileForm
+from models import Session
+from models import SessionForm
+
+
+DATE_FORMAT = "%Y-%m-%d"
+TIME_FORMAT = "%H, %M"
+
+
+def _sharedFields(model_class, message_class):
+    """Yield (message field, ndb property) pairs present in both classes."""
+    properties = dict((prop._code_name, prop)
+                      for prop in model_class._properties.itervalues())
+    for field in message_class.all_fields():
+        if field.name in properties:
+            yield field, properties[field.name]
+
+
+def _enumConverter(enum_type):
+    """Return a function mapping a stored enum name to its Enum value."""
+    return lambda value: getattr(enum_type, value)
+
+
+def entityToMessage(model_class, message_class, key_field=None):
+    """Return a function copying a model_class entity into a message_class.
+
+    Date and time properties are formatted with str(), string properties
+    feeding an EnumField are looked up on the enum, everything else is
+    copied as is. If key_field is given, it receives the entity's urlsafe
+    key. The returned function takes an optional field mask (a set of
+    field names); only masked fields are read from the entity and set.
+    """
+    plan = []
+    for field, prop in _sharedFields(model_class, message_class):
+        if isinstance(prop, ndb.DateTimeProperty):
+            convert = str
+        elif isinstance(field, messages.EnumField):
+            convert = _enumConverter(field.type)
+        else:
+            convert = None
+        plan.append((field.name, convert))
+
+    def convert(entity, mask=None):
+        message = message_class()
+        for name, convert_value in plan:
+            if mask is not None and name not in mask:
+                continue
+            value = getattr(entity, name)
+            setattr(message, name,
+                    convert_value(value) if convert_value else value)
+        if key_field and (mask is None or key_field in mask):
+            setattr(message, key_field, entity.key.urlsafe())
+        return message
+    return convert
+
+
+def parseDate(value):
+    """Parse a 'YYYY-MM-DD...' string into a date."""
+    return datetime.strptime(value[:10], DATE_FORMAT).date()
+
+
+def parseTime(value):
+    """Parse a 'HH, MM' string into a time."""
+    return datetime.strptime(value[:10], TIME_FORMAT).time()
+
+
+def messageToEntityData(message_class, model_class):
+    """Return a function copying a message_class into model_class kwargs.
+
+    Only fields that are properties of model_class are copied; non-empty
+    date and time strings are parsed into date/time objects.
+    """
+    plan = []
+    for field, prop in _sharedFields(model_class, message_class):
+        if isinstance(prop, ndb.DateProperty):
+            parse = parseDate
+        elif isinstance(prop, ndb.TimeProperty):
+            parse = parseTime
+        else:
+            parse = None
+        plan.append((field.name, parse))
+
+    def convert(message):
+        data = {}
+        for name, parse in plan:
+            value = getattr(message, name)
+            data[name] = parse(value) if (parse and value) else value
+        return data
+    return convert
+
+
+conferenceToForm = entityToMessage(Conference, ConferenceForm, 'websafeKey')
+sessionToForm = entityToMessage(Session, SessionForm, 'sessionSafeKey')
+profileToForm = entityToMessage(Profile, ProfileForm)
+
+conferenceFormToData = messageToEntityData(ConferenceForm, Conference)
+sessionFormToData = messageToEntityData(SessionForm, Session)
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+"""counters.py
+
+Sharded seat-allocation counters for Conference registration.
+
+A Conference's seats are split across SeatShard root entities, each holding
+a fixed capacity. Registration only transacts on one shard (plus the user's
+Profile), so concurrent registrations for the same conference no longer
+contend on the Conference entity group. The shard capacities always add up
+to the seats that were available when the shards were created, so the
+counter can never oversell maxAttendees.
+
+"""
+
+import random
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import versionstamp
+from models import SeatShard
+
+from settings import SEAT_SHARDS
+
+
+MEMCACHE_SEATS_KEY = "seats_available_"
+SEATS_CACHE_SECONDS = 60
+SEATS_SYNC_INTERVAL = 10
+
+
+def _shardCapacities(seats, num_shards):
+    """Split seats across num_shards as evenly as possible."""
+    base, extra = divmod(max(seats, 0), num_shards)
+    return [base + (1 if i < extra else 0) for i in range(num_shards)]
+
+
+def shardKeys(conf_key, num_shards):
+    """Return the SeatShard keys belonging to a Conference key."""
+    wsck = conf_key.urlsafe()
+    return [ndb.Key(SeatShard, '%s-%d' % (wsck, i))
+            for i in range(num_shards)]
+
+
+def createShards(conf_key, seats, num_shards=SEAT_SHARDS):
+    """Return (unsaved) SeatShard entities holding seats for a Conference."""
+    return [SeatShard(key=key, capacity=capacity, seatsTaken=0)
+            for key, capacity in zip(shardKeys(conf_key, num_shards),
+                                     _shardCapacities(seats, num_shards))]
+
+
+@ndb.transactional(xg=True)
+def _migrateConference(conf_key, num_shards):
+    """Create shards for a Conference stored before seats were sharded."""
+    conf = conf_key.get()
+    if conf.seatShards:
+        return conf
+    shards = createShards(conf_key, conf.seatsAvailable or 0, num_shards)
+    conf.seatShards = num_shards
+    ndb.put_multi([conf] + shards)
+    return conf
+
+
+def ensureShards(conf):
+    """Make sure conf has a sharded counter, creating one if necessary."""
+    if not conf.seatShards:
+        conf.seatShards = _migrateConference(conf.key, SEAT_SHARDS).seatShards
+    return conf.seatShards
+
+
+def getShards(conf):
+    """Return the SeatShard entities of a Conference."""
+    return ndb.get_multi(shardKeys(conf.key, ensureShards(conf)))
+
+
+def _countSeats(shards):
+    """Return the free seats across a list of shards."""
+    return sum(shard.capacity - shard.seatsTaken
+               for shard in shards if shard)
+
+
+def getSeatsAvailable(conf):
+    """Return the number of free seats of a Conference."""
+    if not conf.seatShards:
+        return conf.seatsAvailable
+    memcache_key = MEMCACHE_SEATS_KEY + conf.key.urlsafe()
+    seats = memcache.get(memcache_key)
+    if seats is None:
+        seats = _countSeats(getShards(conf))
+        memcache.set(memcache_key, seats, time=SEATS_CACHE_SECONDS)
+    return seats
+
+
+def applySeatsAvailable(confs):
+    """Replace seatsAvailable on each Conference with its counter value.
+
+    The values are only set on the in-memory entities for outbound forms;
+    cached counts are read with one memcache call and the shards of any
+    misses with one get_multi.
+    """
+    return applySeatsAvailableAsync(confs).get_result()
+
+
+@ndb.tasklet
+def applySeatsAvailableAsync(confs):
+    """Tasklet version of applySeatsAvailable."""
+    sharded = dict((conf.key.urlsafe(), conf) for conf in confs
+                   if conf and conf.seatShards)
+    if not sharded:
+        raise ndb.Return(confs)
+    ctx = ndb.get_context()
+    wscks = sharded.keys()
+    seats = yield [ctx.memcache_get(MEMCACHE_SEATS_KEY + wsck)
+                   for wsck in wscks]
+    cached = dict((wsck, count) for wsck, count in zip(wscks, seats)
+                  if count is not None)
+
+    misses = [wsck for wsck in sharded if wsck not in cached]
+    keys = []
+    for wsck in misses:
+        keys.extend(shardKeys(sharded[wsck].key, sharded[wsck].seatShards))
+    shards = yield ndb.get_multi_async(keys)
+    computed = {}
+    for wsck in misses:
+        num_shards = sharded[wsck].seatShards
+        computed[wsck] = _countSeats(shards[:num_shards])
+        shards = shards[num_shards:]
+    yield [ctx.memcache_set(MEMCACHE_SEATS_KEY + wsck, count,
+                            time=SEATS_CACHE_SECONDS)
+           for wsck, count in computed.items()]
+
+    cached.update(computed)
+    for wsck, conf in sharded.items():
+        conf.seatsAvailable = cached[wsck]
+    raise ndb.Return(confs)
+
+
+def candidateShards(conf, reg=True):
+    """Return shard keys that can take (reg) or give back a seat.
+
+    Shards are read outside of any transaction and returned in random
+    order so concurrent requests spread across the counter; callers must
+    re-check the shard inside their own transaction.
+    """
+    shards = [shard for shard in getShards(conf) if shard]
+    if reg:
+        shards = [s for s in shards if s.seatsTaken < s.capacity]
+    else:
+        shards = [s for s in shards if s.seatsTaken > 0]
+    random.shuffle(shards)
+    return [shard.key for shard in shards]
+
+
+def seatsChanged(conf_key, delta=None):
+    """Update the cached count and schedule a Conference.seatsAvailable sync.
+
+    The cached count is adjusted by delta free seats, or dropped if delta
+    is None. Returns the new cached count, or None if none was cached; a
+    count cached by a concurrent miss may be a seat off until it expires
+    after SEATS_CACHE_SECONDS.
+    Conference.seatsAvailable is still stored for datastore queries (e.g.
+    the announcement); it is refreshed from the counter at most once per
+    SEATS_SYNC_INTERVAL seconds per conference.
+    """
+    wsck = conf_key.urlsafe()
+    memcache_key = MEMCACHE_SEATS_KEY + wsck
+    seats = None
+    if delta is None:
+        memcache.delete(memcache_key)
+    elif delta >= 0:
+        seats = memcache.incr(memcache_key, delta)
+    else:
+        seats = memcache.decr(memcache_key, -delta)
+    versionstamp.bump(conf_key)
+    try:
+        taskqueue.add(params={'wsck': wsck},
+                      name='sync-seats-%s-%d' % (
+                          wsck, int(time.time()) // SEATS_SYNC_INTERVAL),
+                      countdown=SEATS_SYNC_INTERVAL,
+                      url='/tasks/sync_seats_available')
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+    return seats
+
+
+@ndb.transactional
+def _storeSeatsAvailable(conf_key, seats):
+    """Write seats to Conference.seatsAvailable if it changed."""
+    conf = conf_key.get()
+    if conf and conf.seatsAvailable != seats:
+        conf.seatsAvailable = seats
+        conf.put()
+    return conf
+
+
+def syncSeatsAvailable(conf_key):
+    """Store the counter value on the Conference entity."""
+    conf = conf_key.get()
+    if not conf or not conf.seatShards:
+        return conf
+    seats = _countSeats(ndb.get_multi(shardKeys(conf_key, conf.seatShards)))
+    return _storeSeatsAvailable(conf_key, seats)
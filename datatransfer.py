@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+"""datatransfer.py
+
+Newline-delimited JSON export and import of Profiles, Conferences and
+Sessions, e.g. to seed staging or load-test environments.
+
+Each line holds one entity: its kind, its full key path (so the
+Profile -> Conference -> Session ancestry survives a move to another app)
+and its properties. Keys stored as urlsafe strings in properties are
+written as key paths too, and rebuilt for the importing app. Export walks
+one kind after another page by page with query cursors, and import writes
+in put_multi batches, so neither ever holds more than one page/batch of
+entities.
+
+Import also writes the data derived from Conferences and Sessions: their
+search documents, Speaker entities and speaker indexes, and it renews the
+version stamps and timetables of the affected conferences.
+
+"""
+
+import json
+import time
+from datetime import datetime
+
+from google.appengine.ext import ndb
+
+import entitycache
+import speakerindex
+import speakers
+import textsearch
+import timetable
+import versionstamp
+from models import Conference
+from models import Profile
+from models import Session
+
+
+# parents come first so an import file can be replayed in order
+EXPORT_MODELS = (Profile, Conference, Session)
+EXPORT_PAGE_SIZE = 200
+EXPORT_MAX_ENTITIES = 5000
+IMPORT_BATCH_SIZE = 200
+
+# derived data that is rebuilt on the importing side
+SKIPPED_PROPERTIES = {
+    # sharded seat counters are recreated from seatsAvailable on first use
+    'Conference': ('seatShards',),
+    # computed from startTime and duration
+    'Session': ('timeBuckets',),
+}
+
+# properties holding urlsafe key strings, which name the source app
+KEY_PROPERTIES = {
+    'Profile': ('conferenceKeysToAttend', 'sessionKeysInWishlist'),
+}
+
+_MODELS = dict((model._get_kind(), model) for model in EXPORT_MODELS)
+
+
+def _properties(model_class):
+    """Return the (code name, property) pairs of a model class."""
+    skipped = SKIPPED_PROPERTIES.get(model_class._get_kind(), ())
+    return [(prop._code_name, prop)
+            for prop in model_class._properties.itervalues()
+            if prop._code_name not in skipped]
+
+
+def _keyPath(key):
+    """Return the [[kind, id], ...] path of a key."""
+    flat = key.flat()
+    return [list(flat[i:i + 2]) for i in range(0, len(flat), 2)]
+
+
+def _pathKey(path):
+    """Return the key of this app for a [[kind, id], ...] path."""
+    return ndb.Key(flat=[part for pair in path for part in pair])
+
+
+def _encodeKeyString(value):
+    """Return the key path of a urlsafe key string property value."""
+    if isinstance(value, list):
+        return [_encodeKeyString(v) for v in value]
+    return _keyPath(ndb.Key(urlsafe=value))
+
+
+def _decodeKeyString(value):
+    """Return the urlsafe key string of this app for an exported value.
+
+    Accepts key paths and, from older exports, urlsafe strings of the
+    source app.
+    """
+    if isinstance(value, basestring):
+        return _pathKey(_keyPath(ndb.Key(urlsafe=value))).urlsafe()
+    return _pathKey(value).urlsafe()
+
+
+def _encodeValue(value):
+    """Return a JSON-serializable form of a property value."""
+    if isinstance(value, list):
+        return [_encodeValue(v) for v in value]
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def _decodeValue(prop, value):
+    """Convert a JSON value back into the type of prop."""
+    if value is None:
+        return None
+    if prop._repeated:
+        return [_decodeScalar(prop, v) for v in value]
+    return _decodeScalar(prop, value)
+
+
+def _decodeScalar(prop, value):
+    """Convert a single JSON value back into the type of prop."""
+    if isinstance(prop, ndb.DateProperty):
+        return datetime.strptime(value[:10], "%Y-%m-%d").date()
+    if isinstance(prop, ndb.TimeProperty):
+        return datetime.strptime(value[:8], "%H:%M:%S").time()
+    if isinstance(prop, ndb.DateTimeProperty):
+        return datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
+    return value
+
+
+def entityToLine(entity):
+    """Return the NDJSON line of an entity."""
+    key_properties = KEY_PROPERTIES.get(entity.key.kind(), ())
+    properties = {}
+    for name, prop in _properties(type(entity)):
+        value = getattr(entity, name)
+        if name in key_properties and value is not None:
+            properties[name] = _encodeKeyString(value)
+        else:
+            properties[name] = _encodeValue(value)
+    return json.dumps({
+        'kind': entity.key.kind(),
+        'key': _keyPath(entity.key),
+        'properties': properties,
+    })
+
+
+def lineToEntity(line):
+    """Return the entity of an NDJSON line, or None for non-entity lines."""
+    record = json.loads(line)
+    model_class = _MODELS.get(record.get('kind'))
+    if not model_class:
+        return None
+    key = _pathKey(record['key'])
+    key_properties = KEY_PROPERTIES.get(key.kind(), ())
+    values = record.get('properties', {})
+    data = {}
+    for name, prop in _properties(model_class):
+        if name not in values:
+            continue
+        value = values[name]
+        if name in key_properties and value is not None:
+            data[name] = ([_decodeKeyString(v) for v in value]
+                          if prop._repeated else _decodeKeyString(value))
+        else:
+            data[name] = _decodeValue(prop, value)
+    return model_class(key=key, **data)
+
+
+def _parseToken(token):
+    """Split an export token into (model index, cursor)."""
+    if not token:
+        return 0, None
+    index, _, cursor = token.partition(':')
+    return int(index), (ndb.Cursor(urlsafe=cursor) if cursor else None)
+
+
+def exportLines(token=None, max_entities=EXPORT_MAX_ENTITIES):
+    """Yield NDJSON lines starting at token, ending with a summary line.
+
+    At most max_entities are exported per call; the summary's 'next' token
+    continues the export where it stopped (None once everything is out).
+    """
+    started = time.time()
+    exported = 0
+    index, cursor = _parseToken(token)
+    next_token = None
+    while index < len(EXPORT_MODELS):
+        if exported >= max_entities:
+            next_token = '%d:%s' % (index, cursor.urlsafe() if cursor else '')
+            break
+        page, cursor, more = EXPORT_MODELS[index].query().fetch_page(
+            min(EXPORT_PAGE_SIZE, max_entities - exported),
+            start_cursor=cursor)
+        for entity in page:
+            yield entityToLine(entity) + '\n'
+        exported += len(page)
+        if not (more and cursor):
+            index, cursor = index + 1, None
+
+    elapsed = time.time() - started
+    yield json.dumps({'summary': {
+        'exported': exported,
+        'seconds': elapsed,
+        'entitiesPerSecond': exported / elapsed if elapsed else None,
+        'next': next_token,
+    }}) + '\n'
+
+
+def _reserveIds(entities):
+    """Keep the datastore from allocating numeric IDs that were imported."""
+    highest = {}
+    for entity in entities:
+        key = entity.key
+        if isinstance(key.id(), (int, long)):
+            group = (type(entity), key.parent())
+            highest[group] = max(highest.get(group, 0), key.id())
+    for (model_class, parent), max_id in highest.items():
+        model_class.allocate_ids(max=max_id, parent=parent)
+
+
+def _putBatch(entities):
+    """Write one import batch and the data derived from it."""
+    _reserveIds(entities)
+    searchable = [entity for entity in entities
+                  if isinstance(entity, (Conference, Session))]
+    with entitycache.batch():
+        ndb.put_multi(entities + [textsearch.documentFor(entity)
+                                  for entity in searchable])
+
+    sessions = [entity for entity in entities if isinstance(entity, Session)]
+    speakers.addSessions(sessions)
+    session_confs = set(session.key.parent() for session in sessions)
+    for conf_key in session_confs:
+        speakerindex.rebuildIndex(conf_key)
+    timetable.invalidate(session_confs)
+    for conf_key in session_confs | set(
+            entity.key for entity in entities
+            if isinstance(entity, Conference)):
+        versionstamp.bump(conf_key)
+
+
+def importLines(lines, batch_size=IMPORT_BATCH_SIZE):
+    """Import NDJSON lines from an iterable, returning a summary dict."""
+    started = time.time()
+    imported = 0
+    batch = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        entity = lineToEntity(line)
+        if entity is None:
+            continue
+        batch.append(entity)
+        if len(batch) >= batch_size:
+            _putBatch(batch)
+            imported += len(batch)
+            batch = []
+    if batch:
+        _putBatch(batch)
+        imported += len(batch)
+
+    elapsed = time.time() - started
+    return {
+        'imported': imported,
+        'seconds': elapsed,
+        'entitiesPerSecond': imported / elapsed if elapsed else None,
+    }
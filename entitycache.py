@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+"""entitycache.py
+
+Read-through cache for Conference, Session and Profile lookups by key.
+
+Two tiers are consulted before the datastore:
+
+* a per-request identity map, so the same key is fetched at most once while
+  serving a request;
+* memcache, shared across requests. Every cached entity is stored together
+  with the version it was read under; a separate per-key version entry is
+  replaced with a fresh value whenever the entity is written (see the
+  _post_put_hook of the cached models), which makes older copies unusable.
+
+Writes made in one transaction, or inside a batch() block, replace their
+versions with a single memcache.set_multi after commit. Keys whose IDs were
+allocated by this request cannot have been cached yet, so their first put
+replaces no version at all.
+
+Hit and miss counters for both tiers are kept in-process and exposed by
+getStats().
+
+"""
+
+import contextlib
+import os
+import threading
+import uuid
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+
+CACHED_KINDS = ('Conference', 'Session', 'Profile')
+MEMCACHE_ENTITY_KEY = "entity_"
+MEMCACHE_VERSION_KEY = "entity_version_"
+ENTITY_CACHE_SECONDS = 600
+
+_local = threading.local()
+_stats_lock = threading.Lock()
+_stats = {
+    'requestHits': 0,
+    'memcacheHits': 0,
+    'misses': 0,
+    'invalidations': 0,
+}
+
+
+def _count(name, value=1):
+    """Add value to the named counter."""
+    if value:
+        with _stats_lock:
+            _stats[name] += value
+
+
+def getStats():
+    """Return a copy of the hit/miss counters of this instance."""
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats['requestHits'] + stats['memcacheHits'] + stats['misses']
+    stats['savedRpcs'] = stats['requestHits'] + stats['memcacheHits']
+    stats['hitRatio'] = (float(stats['savedRpcs']) / lookups
+                         if lookups else 0.0)
+    return stats
+
+
+def _identityMap():
+    """Return the identity map of the current request."""
+    request_id = os.environ.get('REQUEST_LOG_ID')
+    if request_id is None:
+        # no way to tell requests apart; don't keep entities around
+        return {}
+    if getattr(_local, 'request_id', None) != request_id or \
+            not hasattr(_local, 'entities'):
+        _local.request_id = request_id
+        _local.entities = {}
+    return _local.entities
+
+
+def _allocations():
+    """Return ([(kind, parent, first, last)], set of written keys) of the
+    IDs allocated by the running request."""
+    request_id = os.environ.get('REQUEST_LOG_ID')
+    if request_id is None:
+        return [], set()
+    if getattr(_local, 'allocated_request_id', None) != request_id:
+        _local.allocated_request_id = request_id
+        _local.allocated = ([], set())
+    return _local.allocated
+
+
+def _isFresh(key):
+    """Return True for the first write of a key allocated by this request.
+
+    Later writes of the key are not fresh: it may have been read and cached
+    since the first one.
+    """
+    ranges, written = _allocations()
+    key_id = key.id()
+    fresh = key not in written and any(
+        kind == key.kind() and parent == key.parent() and
+        first <= key_id <= last
+        for kind, parent, first, last in ranges)
+    if fresh:
+        written.add(key)
+    return fresh
+
+
+def _isCached(key):
+    """Return True if entities of key's kind go through this cache."""
+    return key.kind() in CACHED_KINDS
+
+
+def get(key):
+    """Return the entity for key, or None."""
+    return getMulti([key])[0]
+
+
+def getMulti(keys):
+    """Return the entities for keys (None for missing ones), in order.
+
+    Inside a transaction the datastore is always read directly so the
+    transaction sees (and locks) the stored entities.
+    """
+    return getMultiAsync(keys).get_result()
+
+
+@ndb.tasklet
+def getMultiAsync(keys):
+    """Tasklet version of getMulti, so lookups can overlap other RPCs."""
+    if ndb.in_transaction():
+        entities = yield ndb.get_multi_async(keys)
+        raise ndb.Return(entities)
+
+    ctx = ndb.get_context()
+    entities = _identityMap()
+    missing = [key for key in keys
+               if key not in entities or not _isCached(key)]
+    _count('requestHits', len(keys) - len(missing))
+    missing = list(set(missing))
+
+    # memcache tier: read each entity together with its current version;
+    # the context batches these gets into a single memcache RPC
+    cacheable = [key for key in missing if _isCached(key)]
+    versions = {}
+    if cacheable:
+        cached = yield [[ctx.memcache_get(MEMCACHE_VERSION_KEY + key.urlsafe()),
+                         ctx.memcache_get(MEMCACHE_ENTITY_KEY + key.urlsafe())]
+                        for key in cacheable]
+        for key, (version, value) in zip(cacheable, cached):
+            if version is not None and value and value[0] == version:
+                entities[key] = value[1]
+                missing.remove(key)
+            else:
+                versions[key] = version
+        _count('memcacheHits', len(cacheable) - len(versions))
+
+    # datastore tier
+    result = {}
+    if missing:
+        _count('misses', len([key for key in missing if _isCached(key)]))
+        # only fill entries whose version we managed to claim
+        new_versions = [key for key in versions if versions[key] is None]
+        for key in new_versions:
+            versions[key] = uuid.uuid4().hex
+        added, fetched = yield (
+            [ctx.memcache_add(MEMCACHE_VERSION_KEY + key.urlsafe(),
+                              versions[key])
+             for key in new_versions],
+            ndb.get_multi_async(missing))
+        for key, ok in zip(new_versions, added):
+            if not ok:
+                del versions[key]
+
+        to_cache = []
+        for key, entity in zip(missing, fetched):
+            if _isCached(key):
+                entities[key] = entity
+                if entity and key in versions:
+                    to_cache.append(ctx.memcache_set(
+                        MEMCACHE_ENTITY_KEY + key.urlsafe(),
+                        (versions[key], entity), time=ENTITY_CACHE_SECONDS))
+        yield to_cache
+        result = dict(zip(missing, fetched))
+
+    raise ndb.Return([entities[key] if _isCached(key) else result.get(key)
+                      for key in keys])
+
+
+class _Writes(object):
+
+    """_Writes -- invalidations collected until a commit or batch ends"""
+
+    def __init__(self):
+        self.entities = {}
+        self.callbacks = []
+
+    def flush(self):
+        """Replace the versions of the written keys, then run callbacks."""
+        identity_map = _identityMap()
+        identity_map.update(self.entities)
+        stale = [key for key in self.entities if not _isFresh(key)]
+        if stale:
+            memcache.set_multi(dict(
+                (MEMCACHE_VERSION_KEY + key.urlsafe(), uuid.uuid4().hex)
+                for key in stale))
+            _count('invalidations', len(stale))
+        for callback in self.callbacks:
+            callback()
+
+
+def _currentWrites():
+    """Return the _Writes of the running transaction or batch, or None."""
+    if ndb.in_transaction():
+        ctx = ndb.get_context()
+        writes = getattr(ctx, '_entitycache_writes', None)
+        if writes is None:
+            # a retried transaction runs in a new context, so the writes of
+            # a failed attempt are dropped with its commit callbacks
+            writes = ctx._entitycache_writes = _Writes()
+            ctx.call_on_commit(writes.flush)
+        return writes
+    return getattr(_local, 'writes', None)
+
+
+@contextlib.contextmanager
+def batch():
+    """Collect the invalidations of non-transactional writes in the block.
+
+    They are flushed with one memcache RPC when the block ends, e.g. around
+    a put_multi of many cached entities. Blocks may nest.
+    """
+    if getattr(_local, 'writes', None) is not None:
+        yield
+        return
+    writes = _local.writes = _Writes()
+    try:
+        yield
+    finally:
+        _local.writes = None
+        writes.flush()
+
+
+def afterWrites(callback):
+    """Run callback once after the writes of the current transaction or
+    batch() block have committed, or right away outside of both."""
+    writes = _currentWrites()
+    if writes is None:
+        callback()
+    elif callback not in writes.callbacks:
+        writes.callbacks.append(callback)
+
+
+def invalidate(key, entity=None):
+    """Invalidate key after a write; deferred until commit in transactions."""
+    writes = _currentWrites()
+    if writes is None:
+        writes = _Writes()
+        writes.entities[key] = entity
+        writes.flush()
+    else:
+        writes.entities[key] = entity
+
+
+class CachedModel(ndb.Model):
+
+    """CachedModel -- ndb.Model whose writes invalidate the entity cache"""
+
+    def _post_put_hook(self, future):
+        invalidate(future.get_result(), self)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        invalidate(key)
+
+    @classmethod
+    def _post_allocate_ids_hook(cls, size, max, parent, future):
+        if size is not None:
+            first, last = future.get_result()
+            _allocations()[0].append((cls._get_kind(), parent, first, last))
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""fieldmask.py
+
+Field masks for the list endpoints.
+
+A mask names the message fields a client wants, e.g. "name,websafeKey".
+It narrows the datastore read and trims the serialized message. When only
+the key is wanted the read is keys-only. When every masked field is an
+indexed, single-valued property it is a projection query. Otherwise full
+entities are read. A projection query needs an index covering the
+projected properties (and the query's filters and orders); without one the
+read falls back to full entities.
+
+"""
+
+import endpoints
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+
+
+# read plans: (keys_only, projection)
+FULL_READ = (False, None)
+KEYS_ONLY_READ = (True, None)
+
+
+def parseMask(fields, message_class):
+    """Return the set of field names of a mask, or None for no mask.
+
+    fields is a repeated request field; each entry may itself be a comma
+    separated list. Unknown names raise BadRequest.
+    """
+    names = set()
+    for entry in fields or ():
+        names.update(name.strip() for name in entry.split(',') if name.strip())
+    if not names:
+        return None
+    unknown = names - set(field.name for field in message_class.all_fields())
+    if unknown:
+        raise endpoints.BadRequestException(
+            "Unknown field(s) in 'fields': %s" % ', '.join(sorted(unknown)))
+    return frozenset(names)
+
+
+def wants(mask, name):
+    """Return True if the field name is part of the response."""
+    return mask is None or name in mask
+
+
+def readPlan(model_class, mask, key_field, full_fields=()):
+    """Return the cheapest (keys_only, projection) read serving mask.
+
+    full_fields are fields that are filled in after the read (e.g. from a
+    counter) and therefore need full, writable entities.
+    """
+    if mask is None:
+        return FULL_READ
+    names = mask - set([key_field])
+    if not names:
+        return KEYS_ONLY_READ
+    if names.intersection(full_fields):
+        return FULL_READ
+    projection = []
+    for name in sorted(names):
+        prop = model_class._properties.get(name)
+        if (prop is None or prop._repeated or not prop._indexed or
+                isinstance(prop, ndb.ComputedProperty)):
+            return FULL_READ
+        projection.append(prop)
+    return False, projection
+
+
+def keyStubs(model_class, keys):
+    """Return entities carrying only keys, for keys-only responses."""
+    return [model_class(key=key) for key in keys]
+
+
+@ndb.tasklet
+def fetchAsync(query, plan, page_size=None, start_cursor=None):
+    """Run query with a read plan, returning (entities, cursor, more).
+
+    Without page_size all results are fetched (cursor None, more False).
+    Keys-only results come back as key stubs of the query's model.
+    """
+    keys_only, projection = plan
+
+    @ndb.tasklet
+    def run(options):
+        if page_size is None:
+            results = yield query.fetch_async(**options)
+            raise ndb.Return((results, None, False))
+        results = yield query.fetch_page_async(
+            page_size, start_cursor=start_cursor, **options)
+        raise ndb.Return(results)
+
+    options = {}
+    if keys_only:
+        options['keys_only'] = True
+    elif projection:
+        options['projection'] = projection
+    try:
+        results, cursor, more = yield run(options)
+    except (datastore_errors.NeedIndexError, datastore_errors.BadRequestError):
+        # no index serves the projection (or a projected property is also
+        # filtered on); read full entities instead
+        if not projection:
+            raise
+        results, cursor, more = yield run({})
+
+    if keys_only:
+        results = keyStubs(ndb.Model._lookup_model(query.kind), results)
+    raise ndb.Return((results, cursor, more))
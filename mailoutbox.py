@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+"""mailoutbox.py
+
+Batched, rate-limited outbound mail.
+
+queueMail() stores a notification as an OutboxMail record: the name of a
+template under templates/mail and the few values it needs, not a rendered
+body. The record ID is derived from the template, the recipient and a
+dedupe key, so queueing the same notification twice sends it once. A
+single worker task drains the outbox oldest first, MAIL_BATCH_SIZE records
+per run, and renders each body from its template just before sending.
+
+Sends are limited to MAIL_SEND_RATE_PER_MINUTE by a per-minute counter in
+memcache; when the budget is spent the worker waits for the next minute.
+The mail-outbox queue (queue.yaml) runs one worker at a time, so records
+are never sent concurrently. A record is marked sent after its batch, so a
+worker that dies mid-batch may send some of it again.
+
+"""
+
+import datetime
+import hashlib
+import logging
+import os
+import string
+import time
+
+from google.appengine.api import app_identity
+from google.appengine.api import mail
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from google.appengine.runtime import apiproxy_errors
+
+from models import OutboxMail
+from settings import MAIL_SEND_RATE_PER_MINUTE
+
+
+MAIL_BATCH_SIZE = 20
+MAIL_QUEUE = 'mail-outbox'
+WORKER_URL = '/tasks/send_mail'
+WORKER_DELAY_SECONDS = 5
+RETRY_SECONDS = 60
+MAX_ATTEMPTS = 5
+MEMCACHE_RATE_KEY = 'mail_sent_%d'
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates', 'mail')
+
+PENDING = 'PENDING'
+SENT = 'SENT'
+FAILED = 'FAILED'
+
+_templates = {}
+
+
+def mailKey(template, to, dedupe_key):
+    """Return the key of a notification."""
+    return ndb.Key(OutboxMail, hashlib.sha1((u'%s|%s|%s' % (
+        template, to, dedupe_key)).encode('utf-8')).hexdigest())
+
+
+def render(template, params):
+    """Return (subject, body) of a template filled in with params.
+
+    A template file holds the subject on its first line, then a blank
+    line, then the body; both use string.Template ${name} placeholders.
+    """
+    compiled = _templates.get(template)
+    if compiled is None:
+        with open(os.path.join(TEMPLATE_DIR, template + '.txt')) as f:
+            subject, _, body = f.read().decode('utf-8').partition('\n\n')
+        compiled = _templates[template] = (
+            string.Template(subject.strip()), string.Template(body))
+    return compiled[0].substitute(params), compiled[1].substitute(params)
+
+
+def scheduleWorker():
+    """Run the outbox worker within WORKER_DELAY_SECONDS.
+
+    A burst of queueMail() calls adds at most one task per delay window,
+    so mail queued together goes out in the same batch.
+    """
+    try:
+        taskqueue.add(name='mail-outbox-%d' % (
+                          int(time.time()) // WORKER_DELAY_SECONDS),
+                      countdown=WORKER_DELAY_SECONDS,
+                      queue_name=MAIL_QUEUE,
+                      url=WORKER_URL)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+@ndb.transactional
+def _insert(record):
+    """Store record unless it exists; returns True if it was stored."""
+    if record.key.get():
+        return False
+    record.put()
+    return True
+
+
+def queueMail(template, to, params, dedupe_key):
+    """Queue a notification; returns False if it was queued before.
+
+    params are the template values; keep them to what the template uses.
+    """
+    queued = _insert(OutboxMail(key=mailKey(template, to, dedupe_key),
+                                template=template, to=to, params=params,
+                                status=PENDING))
+    if queued:
+        scheduleWorker()
+    return queued
+
+
+def _takeQuota(wanted):
+    """Reserve up to wanted sends of this minute's budget; returns how many."""
+    key = MEMCACHE_RATE_KEY % (int(time.time()) // 60)
+    memcache.add(key, 0, time=120)
+    used = memcache.incr(key, wanted)
+    if used is None:
+        # memcache unavailable: the batch size still bounds the rate
+        return wanted
+    granted = max(0, min(wanted, MAIL_SEND_RATE_PER_MINUTE - (used - wanted)))
+    if granted < wanted:
+        memcache.decr(key, wanted - granted)
+    return granted
+
+
+def processOutbox():
+    """Send the next batch of pending notifications, chaining the next."""
+    pending = OutboxMail.query(OutboxMail.status == PENDING).order(
+        OutboxMail.created).fetch(MAIL_BATCH_SIZE)
+    if not pending:
+        return
+    batch = pending[:_takeQuota(len(pending))]
+
+    sender = 'noreply@%s.appspotmail.com' % (
+        app_identity.get_application_id())
+    retry = False
+    for record in batch:
+        try:
+            subject, body = render(record.template, record.params)
+        except (IOError, KeyError, ValueError) as e:
+            logging.error('mail %s: bad template %s: %s',
+                          record.key.id(), record.template, e)
+            record.status = FAILED
+            continue
+        try:
+            mail.send_mail(sender, record.to, subject, body)
+        except (mail.Error, apiproxy_errors.Error) as e:
+            record.attempts += 1
+            logging.warning('mail %s: attempt %d failed: %s',
+                            record.key.id(), record.attempts, e)
+            if record.attempts >= MAX_ATTEMPTS:
+                record.status = FAILED
+            else:
+                retry = True
+            continue
+        record.status = SENT
+        record.sent = datetime.datetime.now()
+    ndb.put_multi(batch)
+
+    if len(batch) < len(pending):
+        # out of budget: continue at the start of the next minute
+        countdown = 60 - time.time() % 60
+    elif len(pending) == MAIL_BATCH_SIZE:
+        countdown = 0
+    elif retry:
+        countdown = RETRY_SECONDS
+    else:
+        return
+    taskqueue.add(countdown=countdown, queue_name=MAIL_QUEUE, url=WORKER_URL)
+
+
+def conferenceCreated(conf, to):
+    """Queue the confirmation sent to the organizer of a new conference."""
+    return queueMail('conference_created', to, {
+        'name': conf.name,
+        'displayName': conf.organizerDisplayName or to,
+        'city': conf.city or '',
+        'startDate': str(conf.startDate or ''),
+        'endDate': str(conf.endDate or ''),
+        'topics': ', '.join(conf.topics or []),
+        'maxAttendees': conf.maxAttendees or 0,
+        'description': conf.description or '',
+    }, conf.key.urlsafe())
@@ -1,63 +1,135 @@
 #!/usr/bin/env python
+import json
 import webapp2
-from google.appengine.api import app_identity
-from google.appengine.api import mail
-from google.appengine.api import memcache
 from google.appengine.ext import ndb
 from conference import ConferenceApi
-from conference import MEMCACHE_FEATURED_SPEAKER_KEY
-from models import Session
+import batchjobs
+import counters
+import datatransfer
+import entitycache
+import mailoutbox
+import metrics
+import organizers
+import registrations
+import speakers
+import querycache
+import requestcontext
 
 
-class SendConfirmationEmailHandler(webapp2.RequestHandler):
+class SendMailHandler(webapp2.RequestHandler):
 
     def post(self):
-        """Send email confirming Conference creation."""
-        mail.send_mail(
-            'noreply@%s.appspotmail.com' % (
-                app_identity.get_application_id()),     # from
-            self.request.get('email'),                  # to
-            'You created a new Conference!',            # subj
-            'Hi, you have created a following '         # body
-            'conference:\r\n\r\n%s' % self.request.get(
-                'conferenceInfo')
-        )
+        """Send the next batch of queued mail."""
+        mailoutbox.processOutbox()
 
 
-class CheckFeaturedSpeakerHandler(webapp2.RequestHandler):
+class SyncSeatsAvailableHandler(webapp2.RequestHandler):
 
     def post(self):
-        """Check if added speaker is already speaking at conference.
-        If so, add as Featured Speaker to memecache"""
+        """Copy the sharded seat counter onto Conference.seatsAvailable."""
+        counters.syncSeatsAvailable(ndb.Key(urlsafe=self.request.get('wsck')))
 
-        # get speaker from newly created session
-        speaker = self.request.get('speaker')
-        session_array = []
 
-        # get websafeConferenceKey and then get conference object
-        wsck = self.request.get('wsck')
-        conf = ndb.Key(urlsafe=wsck).get()
+class UpdateOrganizerNamesHandler(webapp2.RequestHandler):
 
-        # get all sessions for conference with ancestry query
-        conference_sessions = Session.query(ancestor=conf.key)
+    def post(self):
+        """Copy an organiser's display name onto a batch of conferences."""
+        cursor = self.request.get('cursor')
+        organizers.updateOrganizerNames(
+            self.request.get('userId'),
+            ndb.Cursor(urlsafe=cursor) if cursor else None)
+
+
+class UpdateSpeakersHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Add newly created sessions to their Speaker entities."""
+        speakers.updateSpeakers(self.request.get('sessionKeys'))
+
+
+class ProcessRegistrationsHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Serve the next batch of queued registrations of a conference."""
+        registrations.processBatch(self.request.get('wsck'))
+
+
+class BatchJobHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Process the next chunk of a batch job shard."""
+        batchjobs.runChunk(self.request.get('shard'),
+                           self.request.get('cursor'))
+
+
+class BatchJobStartHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Start a registered batch job and return its ID."""
+        try:
+            job_key = batchjobs.startJob(self.request.get('name'))
+        except ValueError as e:
+            self.abort(400, str(e))
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({'jobId': job_key.id()}))
 
-        # store all instances of speaker speaking at conference
-        for session in conference_sessions:
-            if session.speaker == speaker:
-                session_array.append(str(session.name))
 
-        # if speaker is speaking more than once, add to memcache
-        if len(session_array) > 1:
-            # create unique memcache key for conference (using conf key):
-            memcache_key = MEMCACHE_FEATURED_SPEAKER_KEY + str(wsck)
+class BatchJobStatusHandler(webapp2.RequestHandler):
 
-            # create string of all sessions by speaker
-            session_string = ', '.join(session_array)
+    def get(self):
+        """Return the progress of a batch job, or the registered job names."""
+        self.response.headers['Content-Type'] = 'application/json'
+        job_id = self.request.get('job')
+        if not job_id:
+            self.response.write(json.dumps(
+                {'jobs': batchjobs.registeredJobs()}))
+            return
+        status = batchjobs.getStatus(int(job_id)) if job_id.isdigit() else None
+        if not status:
+            self.abort(404, 'No batch job found with ID: %s' % job_id)
+        self.response.write(json.dumps(status))
+
+
+class ExportHandler(webapp2.RequestHandler):
+
+    def get(self):
+        """Export Profiles, Conferences and Sessions as NDJSON.
 
-            # set memcache on datastore using key, speaker, and output:
-            memcache.set(memcache_key, "Featured speaker is: {}. Sessions include: {}"
-                                       "".format(speaker,
-                                                 session_string))
+        The last line is a summary whose 'next' token, passed back as
+        ?next=<token>, continues a large export in another request.
+        """
+        self.response.headers['Content-Type'] = 'application/x-ndjson'
+        for line in datatransfer.exportLines(self.request.get('next')):
+            self.response.write(line)
+
+
+class ImportHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Import NDJSON produced by ExportHandler from the request body."""
+        summary = datatransfer.importLines(self.request.body_file)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(summary))
+
+
+class CacheStatsHandler(webapp2.RequestHandler):
+
+    def get(self):
+        """Return cache and per endpoint lookup counters of this instance."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({
+            'entities': entitycache.getStats(),
+            'queries': querycache.getStats(),
+            'endpoints': requestcontext.getStats(),
+        }))
+
+
+class MetricsHandler(webapp2.RequestHandler):
+
+    def get(self):
+        """Return the sampled endpoint/handler metrics of this instance."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(metrics.snapshot()))
 
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
@@ -68,7 +140,18 @@ class SetAnnouncementHandler(webapp2.RequestHandler):
         self.response.set_status(204)
 
 app = webapp2.WSGIApplication([
+    ('/admin/cache_stats', CacheStatsHandler),
+    ('/admin/export', ExportHandler),
+    ('/admin/import', ImportHandler),
+    ('/admin/jobs/start', BatchJobStartHandler),
+    ('/admin/jobs/status', BatchJobStatusHandler),
+    ('/admin/metrics', MetricsHandler),
     ('/crons/set_announcement', SetAnnouncementHandler),
-    ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
-    ('/tasks/check_featured_speaker', CheckFeaturedSpeakerHandler)
+    ('/tasks/send_mail', SendMailHandler),
+    ('/tasks/sync_seats_available', SyncSeatsAvailableHandler),
+    ('/tasks/update_organizer_names', UpdateOrganizerNamesHandler),
+    ('/tasks/process_registrations', ProcessRegistrationsHandler),
+    ('/tasks/update_speakers', UpdateSpeakersHandler),
+    ('/tasks/batch_job', BatchJobHandler)
 ], debug=True)
+app.router.set_dispatcher(requestcontext.dispatchHandler)
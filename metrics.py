@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+"""metrics.py
+
+Sampled hot-path metrics of endpoints and handlers.
+
+A sampled request (METRICS_SAMPLE_RATE of them) carries a Sample that the
+apiproxy hooks in requestcontext fill in: datastore RPCs and their
+latency, memcache hits and misses, and urlfetch calls. When the request
+ends, the sample goes into per-name histograms, together with the wall
+time and the number of response items. Unsampled requests skip all of
+this; their only cost is the sampling decision and a None check per RPC.
+
+Histograms are kept per instance. Totals since instance start are served
+by snapshot(). Every FLUSH_SECONDS the current window is also written to
+the log as JSON, so all instances can be aggregated from the logs.
+
+"""
+
+import bisect
+import json
+import logging
+import random
+import threading
+import time
+
+from settings import METRICS_SAMPLE_RATE
+
+
+FLUSH_SECONDS = 60
+LATENCY_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                     10000, 30000)
+COUNT_BOUNDS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+_lock = threading.Lock()
+_totals = {}
+_window = {}
+_started = _lastFlush = time.time()
+
+
+class Histogram(object):
+
+    """Histogram -- fixed-bucket distribution of a value"""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        """Return the upper bucket bound holding the fraction-th value."""
+        if not self.count:
+            return None
+        rank = max(1, int(round(fraction * self.count)))
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                if index < len(self.bounds):
+                    return min(self.bounds[index], self.max)
+                return self.max
+        return self.max
+
+    def toDict(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(0.50),
+            'p90': self.percentile(0.90),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+
+class Sample(object):
+
+    """Sample -- what one sampled request spent its time on"""
+
+    __slots__ = ('datastoreRpcs', 'datastoreMs', 'memcacheHits',
+                 'memcacheMisses', 'urlfetchCalls', '_rpcStarts')
+
+    def __init__(self):
+        self.datastoreRpcs = 0
+        self.datastoreMs = 0.0
+        self.memcacheHits = 0
+        self.memcacheMisses = 0
+        self.urlfetchCalls = 0
+        self._rpcStarts = {}
+
+    def rpcStarted(self, service, rpc):
+        """Note the start of an RPC (apiproxy pre-call hook)."""
+        if service == 'datastore_v3':
+            self._rpcStarts[id(rpc)] = time.time()
+
+    def rpcFinished(self, service, call, request, response, rpc):
+        """Account for a completed RPC (apiproxy post-call hook)."""
+        if service == 'datastore_v3':
+            self.datastoreRpcs += 1
+            started = self._rpcStarts.pop(id(rpc), None)
+            if started is not None:
+                self.datastoreMs += (time.time() - started) * 1000.0
+        elif service == 'memcache' and call == 'Get':
+            hits = response.item_size()
+            self.memcacheHits += hits
+            self.memcacheMisses += request.key_size() - hits
+        elif service == 'urlfetch':
+            self.urlfetchCalls += 1
+
+
+class _Metrics(object):
+
+    """_Metrics -- histograms of one endpoint or handler"""
+
+    def __init__(self):
+        self.wallMs = Histogram(LATENCY_BOUNDS_MS)
+        self.datastoreMs = Histogram(LATENCY_BOUNDS_MS)
+        self.datastoreRpcs = Histogram(COUNT_BOUNDS)
+        self.memcacheHits = 0
+        self.memcacheMisses = 0
+        self.urlfetchCalls = Histogram(COUNT_BOUNDS)
+        self.items = Histogram(COUNT_BOUNDS)
+        self.errors = 0
+
+    def add(self, sample, wall_ms, items, failed):
+        self.wallMs.add(wall_ms)
+        self.datastoreMs.add(sample.datastoreMs)
+        self.datastoreRpcs.add(sample.datastoreRpcs)
+        self.memcacheHits += sample.memcacheHits
+        self.memcacheMisses += sample.memcacheMisses
+        self.urlfetchCalls.add(sample.urlfetchCalls)
+        if items is not None:
+            self.items.add(items)
+        self.errors += 1 if failed else 0
+
+    def toDict(self):
+        lookups = self.memcacheHits + self.memcacheMisses
+        return {
+            'wallMs': self.wallMs.toDict(),
+            'datastoreMs': self.datastoreMs.toDict(),
+            'datastoreRpcs': self.datastoreRpcs.toDict(),
+            'memcacheHits': self.memcacheHits,
+            'memcacheMisses': self.memcacheMisses,
+            'memcacheHitRate': (float(self.memcacheHits) / lookups
+                                if lookups else None),
+            'urlfetchCalls': self.urlfetchCalls.toDict(),
+            'responseItems': self.items.toDict(),
+            'errors': self.errors,
+        }
+
+
+def newSample():
+    """Return a Sample for a new request, or None if it isn't sampled."""
+    if METRICS_SAMPLE_RATE and random.random() < METRICS_SAMPLE_RATE:
+        return Sample()
+    return None
+
+
+def _flush(now):
+    """Log and reset the current window (caller holds _lock)."""
+    global _window, _lastFlush
+    if _window:
+        logging.info('metrics %s', json.dumps({
+            'seconds': now - _lastFlush,
+            'sampleRate': METRICS_SAMPLE_RATE,
+            'metrics': dict((name, metrics.toDict())
+                            for name, metrics in _window.items()),
+        }))
+    _window = {}
+    _lastFlush = now
+
+
+def record(name, sample, wall_seconds, items=None, failed=False):
+    """Add a finished sampled request of endpoint/handler name."""
+    now = time.time()
+    with _lock:
+        for aggregate in (_totals, _window):
+            metrics = aggregate.get(name)
+            if metrics is None:
+                metrics = aggregate[name] = _Metrics()
+            metrics.add(sample, wall_seconds * 1000.0, items, failed)
+        if now - _lastFlush >= FLUSH_SECONDS:
+            _flush(now)
+
+
+def snapshot():
+    """Return the aggregates of this instance since it started."""
+    with _lock:
+        return {
+            'sampleRate': METRICS_SAMPLE_RATE,
+            'seconds': time.time() - _started,
+            'metrics': dict((name, metrics.toDict())
+                            for name, metrics in _totals.items()),
+        }
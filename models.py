@@ -17,8 +17,12 @@ import endpoints
 from protorpc import messages
 from google.appengine.ext import ndb
 
+import entitycache
+from entitycache import CachedModel
+import querycache
 
-class Profile(ndb.Model):
+
+class Profile(CachedModel):
 
     """Profile -- User profile object"""
     userId = ndb.StringProperty()
@@ -71,7 +75,7 @@ class TeeShirtSize(messages.Enum):
     XXXL_W = 15
 
 
-class Conference(ndb.Model):
+class Conference(CachedModel):
 
     """Conference -- Conference object"""
     name = ndb.StringProperty(required=True)
@@ -84,6 +88,32 @@ class Conference(ndb.Model):
     endDate = ndb.DateProperty()
     maxAttendees = ndb.IntegerProperty()
     seatsAvailable = ndb.IntegerProperty()
+    seatShards = ndb.IntegerProperty()
+    # copy of the organiser's Profile.displayName, see organizers.py
+    organizerDisplayName = ndb.StringProperty(indexed=False)
+
+    def _post_put_hook(self, future):
+        super(Conference, self)._post_put_hook(future)
+        # any Conference write may change query results
+        _bumpQueryCache()
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        super(Conference, cls)._post_delete_hook(key, future)
+        # cached pages would still hold the deleted key
+        _bumpQueryCache()
+
+
+def _bumpQueryCache():
+    """Invalidate cached Conference queries once per transaction or batch."""
+    entitycache.afterWrites(querycache.bumpGeneration)
+
+
+class SeatShard(ndb.Model):
+
+    """SeatShard -- one slice of a Conference's sharded seat counter"""
+    capacity = ndb.IntegerProperty(default=0, indexed=False)
+    seatsTaken = ndb.IntegerProperty(default=0, indexed=False)
 
 
 class ConferenceForm(messages.Message):
@@ -107,6 +137,7 @@ class ConferenceForms(messages.Message):
 
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
 
 
 class ConferenceQueryForm(messages.Message):
@@ -121,12 +152,17 @@ class ConferenceQueryForms(messages.Message):
 
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2)
+    pageToken = messages.StringField(3)
+    fields = messages.StringField(4, repeated=True)
 
 
 class StringMessage(messages.Message):
 
     """StringMessage-- outbound (single) string message"""
     data = messages.StringField(1, required=True)
+    etag = messages.StringField(2)
+    notModified = messages.BooleanField(3)
 
 
 class BooleanMessage(messages.Message):
@@ -141,7 +177,21 @@ class ConflictException(endpoints.ServiceException):
     http_status = httplib.CONFLICT
 
 
-class Session(ndb.Model):
+def sessionMinutes(start_time, duration):
+    """Return the [start, end) minutes of the day of a session."""
+    start = start_time.hour * 60 + start_time.minute
+    return start, start + max(duration or 0, 1)
+
+
+def sessionTimeBuckets(start_time, duration):
+    """Return the hours of the day a session starting at start_time covers."""
+    if start_time is None:
+        return []
+    start, end = sessionMinutes(start_time, duration)
+    return range(start // 60, min((end - 1) // 60, 23) + 1)
+
+
+class Session(CachedModel):
 
     """Session -- Session object"""
     name = ndb.StringProperty()
@@ -151,6 +201,11 @@ class Session(ndb.Model):
     typeOfSession = ndb.StringProperty(repeated=True)
     date = ndb.DateProperty()
     startTime = ndb.TimeProperty()
+    # hours of the day (0-23) the session overlaps; an interval index that
+    # lets time window queries read a narrow range instead of every session
+    timeBuckets = ndb.ComputedProperty(
+        lambda self: sessionTimeBuckets(self.startTime, self.duration),
+        repeated=True)
 
 
 class SessionForm(messages.Message):
@@ -170,3 +225,112 @@ class SessionForms(messages.Message):
 
     """SessionForms -- multiple Session outbound form message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    etag = messages.StringField(3)
+    notModified = messages.BooleanField(4)
+
+
+class Speaker(ndb.Model):
+
+    """Speaker -- a speaker across conferences, keyed by normalized name"""
+    name = ndb.StringProperty(required=True, indexed=False)
+    aliases = ndb.StringProperty(repeated=True, indexed=False)
+    sessionKeys = ndb.KeyProperty(kind='Session', repeated=True, indexed=False)
+    sessionCount = ndb.ComputedProperty(lambda self: len(self.sessionKeys))
+
+
+class SpeakerForm(messages.Message):
+
+    """SpeakerForm -- Speaker outbound form message"""
+    name = messages.StringField(1)
+    aliases = messages.StringField(2, repeated=True)
+    sessionCount = messages.IntegerField(3)
+
+
+class SpeakerForms(messages.Message):
+
+    """SpeakerForms -- multiple Speaker outbound form message"""
+    items = messages.MessageField(SpeakerForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+
+class SpeakerIndex(ndb.Model):
+
+    """SpeakerIndex -- per-Conference speaker to session names index"""
+    sessionsBySpeaker = ndb.JsonProperty()
+    featuredSpeaker = ndb.StringProperty(indexed=False)
+
+
+class Timetable(ndb.Model):
+
+    """Timetable -- per-Conference sorted SessionForms, see timetable.py"""
+    sessions = ndb.JsonProperty(compressed=True)
+    types = ndb.JsonProperty(compressed=True)
+
+
+class BatchJob(ndb.Model):
+
+    """BatchJob -- one run of a registered batch job"""
+    name = ndb.StringProperty(required=True)
+    shardKeys = ndb.KeyProperty(repeated=True, indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class BatchJobShard(ndb.Model):
+
+    """BatchJobShard -- progress of one key range of one BatchJob stage"""
+    jobId = ndb.IntegerProperty(required=True)
+    stage = ndb.IntegerProperty(required=True, indexed=False)
+    startKey = ndb.KeyProperty(indexed=False)
+    endKey = ndb.KeyProperty(indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    processed = ndb.IntegerProperty(default=0, indexed=False)
+    done = ndb.BooleanProperty(default=False, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+class AlmostSoldOut(ndb.Model):
+
+    """AlmostSoldOut -- conferences with only a few seats left"""
+    conferences = ndb.JsonProperty()
+
+
+class SearchDocument(ndb.Model):
+
+    """SearchDocument -- inverted index entry, child of the indexed entity"""
+    kind = ndb.StringProperty(required=True)
+    tokens = ndb.StringProperty(repeated=True)
+    prefixes = ndb.StringProperty(repeated=True)
+    weights = ndb.JsonProperty()
+
+
+class RegistrationTicket(ndb.Model):
+
+    """RegistrationTicket -- queued registration of a user, see registrations.py"""
+    userId = ndb.StringProperty(required=True)
+    conferenceKey = ndb.StringProperty(required=True)
+    status = ndb.StringProperty(required=True)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class RegistrationTicketForm(messages.Message):
+
+    """RegistrationTicketForm -- queued registration outbound form message"""
+    ticketId = messages.StringField(1)
+    websafeConferenceKey = messages.StringField(2)
+    status = messages.StringField(3)
+    created = messages.StringField(4)
+    updated = messages.StringField(5)
+
+
+class OutboxMail(ndb.Model):
+
+    """OutboxMail -- queued notification, see mailoutbox.py"""
+    template = ndb.StringProperty(required=True, indexed=False)
+    to = ndb.StringProperty(required=True, indexed=False)
+    params = ndb.JsonProperty()
+    status = ndb.StringProperty(required=True)
+    attempts = ndb.IntegerProperty(default=0, indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    sent = ndb.DateTimeProperty(indexed=False)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""organizers.py
+
+Keeps Conference.organizerDisplayName, a copy of the organiser's
+Profile.displayName, in step with the profile.
+
+The name is stored on every Conference when it is created, so list
+endpoints never look up organiser profiles. When a display name changes,
+displayNameChanged() enqueues a task that walks the organiser's
+conferences with an ancestor query, UPDATE_BATCH_SIZE at a time, and
+chains itself with a cursor. Each batch runs in a transaction on the
+organiser's entity group, so it cannot overwrite concurrent seat syncs.
+The name is read from the Profile when the batch runs, so the last change
+wins whatever order the tasks run in.
+
+"""
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import Profile
+
+
+UPDATE_BATCH_SIZE = 50
+
+
+def _enqueue(user_id, cursor=None):
+    """Queue the update of the next batch of a user's conferences."""
+    params = {'userId': user_id}
+    if cursor:
+        params['cursor'] = cursor.urlsafe()
+    taskqueue.add(params=params, url='/tasks/update_organizer_names',
+                  transactional=ndb.in_transaction())
+
+
+def displayNameChanged(profile):
+    """Schedule copying profile.displayName onto its conferences."""
+    _enqueue(profile.key.id())
+
+
+@ndb.transactional
+def _renameBatch(keys, display_name):
+    """Set the organiser name on one batch of conferences."""
+    conferences = [conf for conf in ndb.get_multi(keys)
+                   if conf and conf.organizerDisplayName != display_name]
+    for conf in conferences:
+        conf.organizerDisplayName = display_name
+    ndb.put_multi(conferences)
+
+
+def updateOrganizerNames(user_id, cursor=None):
+    """Update one batch of a user's conferences, chaining the next batch."""
+    p_key = ndb.Key(Profile, user_id)
+    profile = p_key.get()
+    if not profile:
+        return
+    keys, next_cursor, more = Conference.query(ancestor=p_key).fetch_page(
+        UPDATE_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+    if keys:
+        _renameBatch(keys, profile.displayName)
+    if more and next_cursor:
+        _enqueue(user_id, next_cursor)
+
+
+def backfillOrganizerNames(conferences):
+    """Batch job mapper copying organiser names onto older conferences."""
+    profiles = ndb.get_multi(list(set(
+        ndb.Key(Profile, conf.organizerUserId)
+        for conf in conferences if conf.organizerUserId)))
+    names = dict((profile.key.id(), profile.displayName)
+                 for profile in profiles if profile)
+    changed = []
+    for conf in conferences:
+        name = names.get(conf.organizerUserId)
+        if name and conf.organizerDisplayName != name:
+            conf.organizerDisplayName = name
+            changed.append(conf)
+    return changed, []
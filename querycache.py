@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""querycache.py
+
+Result cache for queryConferences.
+
+Entries are keyed by a canonical form of the formatted filters (sorted, with
+typed values) plus the requested page, and hold the page's Conference keys
+and next page token. Every entry records the global conference generation it
+was computed under; the generation is bumped whenever a Conference is
+written, which turns all older entries into misses. Entries also expire
+after QUERY_CACHE_SECONDS, which bounds how stale a result can get should a
+generation bump be lost.
+
+"""
+
+import hashlib
+import json
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+
+MEMCACHE_GENERATION_KEY = "conference_generation"
+MEMCACHE_QUERY_KEY = "conference_query_"
+QUERY_CACHE_SECONDS = 300
+
+_stats_lock = threading.Lock()
+_stats = {
+    'hits': 0,
+    'misses': 0,
+    'staleEntries': 0,
+    'generationBumps': 0,
+    'maxServedAgeSeconds': 0,
+}
+
+
+def _count(name, value=1):
+    """Add value to the named counter."""
+    with _stats_lock:
+        _stats[name] += value
+
+
+def getStats():
+    """Return a copy of the query cache counters of this instance."""
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hitRatio'] = float(stats['hits']) / lookups if lookups else 0.0
+    stats['maxStaleSeconds'] = QUERY_CACHE_SECONDS
+    return stats
+
+
+def queryKey(filters, page_size, page_token):
+    """Return the memcache key of a formatted filter list and page."""
+    canonical = sorted((f['field'], f['operator'], f['value'])
+                       for f in filters)
+    digest = hashlib.md5(json.dumps(
+        [canonical, page_size, page_token])).hexdigest()
+    return MEMCACHE_QUERY_KEY + digest
+
+
+def bumpGeneration():
+    """Invalidate every cached query result."""
+    # a fresh generation is seeded from the clock so values never repeat
+    # after the counter is evicted from memcache
+    memcache.incr(MEMCACHE_GENERATION_KEY,
+                  initial_value=int(time.time() * 1000))
+    _count('generationBumps')
+
+
+def lookup(cache_key):
+    """Return (generation, (keys, next_token) or None) for cache_key.
+
+    The returned generation must be passed to store() so the entry is tagged
+    with the generation read before the datastore was queried.
+    """
+    cached = memcache.get_multi([MEMCACHE_GENERATION_KEY, cache_key])
+    generation = cached.get(MEMCACHE_GENERATION_KEY)
+    if generation is None:
+        generation = int(time.time() * 1000)
+        if not memcache.add(MEMCACHE_GENERATION_KEY, generation):
+            generation = memcache.get(MEMCACHE_GENERATION_KEY)
+
+    entry = cached.get(cache_key)
+    if entry and entry['generation'] == generation:
+        age = int(time.time() - entry['created'])
+        with _stats_lock:
+            _stats['hits'] += 1
+            _stats['maxServedAgeSeconds'] = max(
+                _stats['maxServedAgeSeconds'], age)
+        keys = [ndb.Key(urlsafe=key) for key in entry['keys']]
+        return generation, (keys, entry['nextPageToken'])
+
+    if entry:
+        _count('staleEntries')
+    _count('misses')
+    return generation, None
+
+
+def store(cache_key, generation, keys, next_token):
+    """Cache the Conference keys and next page token of a query page."""
+    if generation is None:
+        return
+    memcache.set(cache_key, {
+        'generation': generation,
+        'created': time.time(),
+        'keys': [key.urlsafe() for key in keys],
+        'nextPageToken': next_token,
+    }, time=QUERY_CACHE_SECONDS)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+"""queryplanner.py
+
+Plans queryConferences filter combinations so that any combination can run
+with one (field, name) composite index per filterable field.
+
+There are three kinds of plan:
+
+ native  -- filters on at most one field. One query ordered by (field,)
+            name, served by that field's (field, name) index.
+ zigzag  -- equality filters on several fields. Without a sort order the
+            datastore merge-joins the built-in single-property indexes.
+            Results come in key order.
+ scan    -- inequalities together with filters on other fields. The
+            cheapest part that a native or zigzag query can serve drives
+            the query (all the equalities, or the filters of one
+            inequality field). The remaining filters are checked in
+            memory, scanning at most MAX_SCAN entities per page.
+
+The driving part is picked by estimated selectivity: the share of a cached
+sample of stored values that passes its filters. Page tokens carry the
+name of their plan, so a change in the statistics between two pages never
+switches the query under a cursor.
+
+"""
+
+import logging
+import operator
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import fieldmask
+from models import Conference
+
+
+PLANNED_FIELDS = ('city', 'topics', 'month', 'maxAttendees')
+MAX_SCAN = 1000
+SCAN_BATCH_SIZE = 100
+STATS_SAMPLE_SIZE = 500
+STATS_CACHE_SECONDS = 3600
+MEMCACHE_STATS_KEY = "conference_field_stats"
+
+# selectivity guesses used until there is a sample
+DEFAULT_SELECTIVITY = {'=': 0.1}
+DEFAULT_INEQUALITY_SELECTIVITY = 1 / 3.0
+
+COMPARATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+class Plan(object):
+
+    """Plan -- how one filter list is executed"""
+
+    def __init__(self, name, query_filters, post_filters):
+        self.name = name
+        self.queryFilters = query_filters
+        self.postFilters = post_filters
+
+    def query(self):
+        """Return the datastore query of the plan."""
+        q = Conference.query()
+        for f in self.queryFilters:
+            q = q.filter(ndb.query.FilterNode(
+                f['field'], f['operator'], f['value']))
+
+        fields = set(f['field'] for f in self.queryFilters)
+        inequality = [f['field'] for f in self.queryFilters
+                      if f['operator'] != '=']
+        if inequality:
+            # served by the (field, name) index
+            q = q.order(ndb.GenericProperty(inequality[0]))
+            q = q.order(Conference.name)
+        elif len(fields) <= 1:
+            q = q.order(Conference.name)
+        # several equality fields: unordered, so a merge join suffices
+
+        if any(f['operator'] == '!=' for f in self.queryFilters):
+            # ndb runs != as a multi-query, which only takes cursors when
+            # ordered by key; the (field, name) index already ends in it
+            q = q.order(Conference._key)
+        return q
+
+
+def _groupByField(filters):
+    """Return ({field: [filters]}, [fields with an inequality])."""
+    by_field = {}
+    for f in filters:
+        by_field.setdefault(f['field'], []).append(f)
+    inequality_fields = sorted(
+        field for field, field_filters in by_field.items()
+        if any(f['operator'] != '=' for f in field_filters))
+    return by_field, inequality_fields
+
+
+def fieldStats():
+    """Return {field: sampled stored values}, cached in memcache."""
+    stats = memcache.get(MEMCACHE_STATS_KEY)
+    if stats is None:
+        sample = Conference.query().fetch(STATS_SAMPLE_SIZE)
+        stats = dict((field, [getattr(conf, field) for conf in sample])
+                     for field in PLANNED_FIELDS)
+        memcache.set(MEMCACHE_STATS_KEY, stats, time=STATS_CACHE_SECONDS)
+    return stats
+
+
+def matches(entity, filters):
+    """Return True if entity passes every filter (datastore semantics).
+
+    A filter on a repeated property passes if any of its values does.
+    """
+    for f in filters:
+        value = getattr(entity, f['field'])
+        values = value if isinstance(value, list) else [value]
+        compare = COMPARATORS[f['operator']]
+        if not any(compare(v, f['value']) for v in values):
+            return False
+    return True
+
+
+def _selectivity(filters, stats):
+    """Return the estimated share of conferences passing filters."""
+    field = filters[0]['field']
+    sample = stats.get(field)
+    if not sample:
+        estimate = 1.0
+        for f in filters:
+            estimate *= DEFAULT_SELECTIVITY.get(
+                f['operator'], DEFAULT_INEQUALITY_SELECTIVITY)
+        return estimate
+    passed = sum(1 for value in sample
+                 if matches(_Values(field, value), filters))
+    return max(passed, 1) / float(len(sample) + 1)
+
+
+class _Values(object):
+
+    """_Values -- a sampled value dressed as an entity for matches()"""
+
+    def __init__(self, field, value):
+        setattr(self, field, value)
+
+
+def _estimate(driver, stats):
+    """Return the estimated share of conferences a driving query reads."""
+    by_field, _ = _groupByField(driver)
+    estimate = 1.0
+    for field_filters in by_field.values():
+        # fields are assumed independent
+        estimate *= _selectivity(field_filters, stats)
+    return estimate
+
+
+def _candidates(filters):
+    """Return {plan name: (query filters, post filters)} of a filter list."""
+    by_field, inequality_fields = _groupByField(filters)
+    if len(by_field) <= 1:
+        return {'native': (filters, [])}
+    if not inequality_fields:
+        return {'zigzag': (filters, [])}
+
+    candidates = {}
+    equalities = [f for f in filters if f['field'] not in inequality_fields]
+    if equalities:
+        candidates['scan-eq'] = (
+            equalities, [f for f in filters if f not in equalities])
+    for field in inequality_fields:
+        candidates['scan-' + field] = (
+            by_field[field], [f for f in filters if f['field'] != field])
+    return candidates
+
+
+def plan(filters, name=None):
+    """Return the Plan of filters formatted by ConferenceApi._formatFilters.
+
+    With name (from a page token) that plan is rebuilt; a name that does
+    not fit the filters raises ValueError.
+    """
+    candidates = _candidates(filters)
+    if name is None:
+        if len(candidates) == 1:
+            name = candidates.keys()[0]
+        else:
+            stats = fieldStats()
+            name = min(sorted(candidates), key=lambda candidate: _estimate(
+                candidates[candidate][0], stats))
+            logging.debug('query plan %s of %s', name, sorted(candidates))
+    if name not in candidates:
+        raise ValueError('Unknown query plan: %s' % name)
+    return Plan(name, *candidates[name])
+
+
+@ndb.tasklet
+def fetchPageAsync(query_plan, page_size, cursor=None,
+                   read_plan=fieldmask.FULL_READ):
+    """Return (entities, next cursor or None) of one page of a plan.
+
+    Scan plans need full entities for the in-memory filters, so read_plan
+    only applies to native and zigzag plans. A scan page may hold fewer
+    than page_size entities if MAX_SCAN entities were read first.
+    """
+    query = query_plan.query()
+    if not query_plan.postFilters:
+        entities, next_cursor, more = yield fieldmask.fetchAsync(
+            query, read_plan, page_size, cursor)
+        raise ndb.Return((entities, next_cursor if more else None))
+
+    matched = []
+    scanned = 0
+    next_cursor = None
+    it = query.iter(start_cursor=cursor, produce_cursors=True,
+                    batch_size=SCAN_BATCH_SIZE)
+    while (yield it.has_next_async()):
+        entity = it.next()
+        scanned += 1
+        if matches(entity, query_plan.postFilters):
+            matched.append(entity)
+        if len(matched) >= page_size or scanned >= MAX_SCAN:
+            # no cursor if the page ended on the last entity
+            if (yield it.has_next_async()):
+                next_cursor = it.cursor_after()
+            break
+    raise ndb.Return((matched, next_cursor))
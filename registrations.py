@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""registrations.py
+
+Queued conference registration, for ticket releases that draw more
+registrations than the seat transactions can take one at a time.
+
+queueRegistration stores a RegistrationTicket (a root entity, so intake
+never contends) and returns its ID right away. A worker task per conference
+drains the tickets oldest first, REGISTRATION_BATCH_SIZE per cross-group
+transaction. Each transaction takes the seats from at most MAX_BATCH_SHARDS
+seat shards and updates the attendees' Profiles. Registrations per
+conference are therefore bounded by the batch size, not by the transaction
+rate. Tickets that find the conference sold out go on the waitlist; it is
+served first, oldest first, whenever seats are free again. Clients poll the
+ticket for its status.
+
+"""
+
+import hashlib
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import announcements
+import counters
+import entitycache
+from models import Profile
+from models import RegistrationTicket
+
+
+# tickets, profiles and shards of a batch must stay within the 25 entity
+# groups of a cross-group transaction
+REGISTRATION_BATCH_SIZE = 10
+MAX_BATCH_SHARDS = 5
+WORKER_URL = '/tasks/process_registrations'
+WORKER_DELAY_SECONDS = 1
+STALE_TICKET_SECONDS = 60
+
+QUEUED = 'QUEUED'
+REGISTERED = 'REGISTERED'
+WAITLISTED = 'WAITLISTED'
+REJECTED = 'REJECTED'
+
+
+def ticketKey(user_id, wsck):
+    """Return the key of a user's ticket for a conference."""
+    return ndb.Key(RegistrationTicket,
+                   hashlib.sha1('%s|%s' % (user_id, wsck)).hexdigest())
+
+
+def scheduleWorker(wsck):
+    """Make sure the worker of a conference runs soon (at most once/s)."""
+    try:
+        taskqueue.add(params={'wsck': wsck},
+                      name='registrations-%s-%d' % (
+                          wsck, int(time.time()) // WORKER_DELAY_SECONDS),
+                      countdown=WORKER_DELAY_SECONDS,
+                      url=WORKER_URL)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def enqueue(user_id, wsck):
+    """Queue a registration, returning its (new or still open) ticket."""
+    key = ticketKey(user_id, wsck)
+    ticket = key.get()
+    if not ticket or ticket.status not in (QUEUED, WAITLISTED):
+        ticket = RegistrationTicket(key=key, userId=user_id,
+                                    conferenceKey=wsck, status=QUEUED)
+        ticket.put()
+    scheduleWorker(wsck)
+    return ticket
+
+
+def getTicket(ticket_id):
+    """Return a ticket by ID, nudging the worker if it looks stuck."""
+    ticket = ndb.Key(RegistrationTicket, ticket_id).get()
+    if ticket and ticket.status == QUEUED and \
+            time.time() - time.mktime(ticket.updated.timetuple()) > \
+            STALE_TICKET_SECONDS:
+        scheduleWorker(ticket.conferenceKey)
+    return ticket
+
+
+def _nextBatch(wsck, seats_free):
+    """Return the keys of the next tickets to serve, oldest first."""
+    statuses = (WAITLISTED, QUEUED) if seats_free else (QUEUED,)
+    for status in statuses:
+        keys = RegistrationTicket.query(
+            RegistrationTicket.conferenceKey == wsck,
+            RegistrationTicket.status == status,
+        ).order(RegistrationTicket.created).fetch(
+            REGISTRATION_BATCH_SIZE, keys_only=True)
+        if keys:
+            return keys
+    return []
+
+
+@ndb.transactional(xg=True)
+def _assignBatch(wsck, ticket_keys, shard_keys, more_shards):
+    """Serve a batch of tickets in order; returns (seats taken, changed).
+
+    Tickets are re-read, so a batch delivered twice changes nothing. When
+    the batch's shards run out, the remaining tickets wait for the next
+    batch if more_shards, else they are waitlisted.
+    """
+    tickets = [ticket for ticket in ndb.get_multi(ticket_keys)
+               if ticket and ticket.status in (QUEUED, WAITLISTED)]
+    if not tickets:
+        return 0, 0
+    profiles = dict((prof.key.id(), prof) for prof in ndb.get_multi(
+        list(set(ndb.Key(Profile, t.userId) for t in tickets))) if prof)
+    free = [shard for shard in ndb.get_multi(shard_keys)
+            if shard and shard.seatsTaken < shard.capacity]
+
+    changed = {}
+    taken = 0
+    for ticket in tickets:
+        prof = profiles.get(ticket.userId)
+        if prof is None:
+            ticket.status = REJECTED
+        elif wsck in prof.conferenceKeysToAttend:
+            # registered meanwhile, e.g. through registerForConference
+            ticket.status = REGISTERED
+        else:
+            while free and free[0].seatsTaken >= free[0].capacity:
+                free.pop(0)
+            if free:
+                free[0].seatsTaken += 1
+                prof.conferenceKeysToAttend.append(wsck)
+                changed[free[0].key] = free[0]
+                changed[prof.key] = prof
+                ticket.status = REGISTERED
+                taken += 1
+            elif more_shards:
+                break
+            elif ticket.status == WAITLISTED:
+                continue
+            else:
+                ticket.status = WAITLISTED
+        changed[ticket.key] = ticket
+
+    ndb.put_multi(changed.values())
+    return taken, len([key for key in changed
+                       if key.kind() == RegistrationTicket._get_kind()])
+
+
+def processBatch(wsck):
+    """Serve the next batch of a conference's tickets, chaining the next."""
+    conf = entitycache.get(ndb.Key(urlsafe=wsck))
+    if not conf:
+        return
+    # fullest shards last, so a batch needs as few shards as possible
+    shards = [shard for shard in counters.getShards(conf)
+              if shard and shard.seatsTaken < shard.capacity]
+    shards.sort(key=lambda shard: shard.seatsTaken - shard.capacity)
+    ticket_keys = _nextBatch(wsck, bool(shards))
+    if not ticket_keys:
+        return
+
+    more_shards = len(shards) > MAX_BATCH_SHARDS
+    taken, changed = _assignBatch(
+        wsck, ticket_keys, [shard.key for shard in shards[:MAX_BATCH_SHARDS]],
+        more_shards)
+    if taken:
+        seats = counters.seatsChanged(conf.key, -taken)
+        announcements.seatsChanged(conf, seats if seats is not None
+                                   else counters.getSeatsAvailable(conf))
+    if changed or more_shards:
+        # more tickets may be waiting, or this batch's shards filled up
+        # while other shards still have seats; unnamed, so it always chains
+        taskqueue.add(params={'wsck': wsck}, url=WORKER_URL)
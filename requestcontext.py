@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+"""requestcontext.py
+
+Request-scoped identity and Profile memoization for ConferenceApi.
+
+Every endpoint method is wrapped with @endpoint, and every main.py handler
+is dispatched by dispatchHandler; both give the request a RequestContext.
+The context resolves the current user, their user ID and their Profile at
+most once, however many helpers ask for them. It also counts the
+datastore RPCs and auth lookups the call performs; the per endpoint totals
+are available from getStats(). Sampled requests also carry a
+metrics.Sample that the apiproxy hooks fill in (see metrics.py).
+
+"""
+
+import functools
+import logging
+import threading
+import time
+
+import endpoints
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb
+
+import entitycache
+import metrics
+from models import Profile
+from models import TeeShirtSize
+from utils import getUserId
+
+
+_local = threading.local()
+_stats_lock = threading.Lock()
+_stats = {}
+
+_UNSET = object()
+
+
+class RequestContext(object):
+
+    """RequestContext -- lazily resolved identity of one request"""
+
+    def __init__(self, sample=None):
+        self._user = _UNSET
+        self._user_id = _UNSET
+        self._profile = None
+        self.datastoreRpcs = 0
+        self.authLookups = 0
+        self.sample = sample
+
+    @property
+    def user(self):
+        """Return the current endpoints user (or None)."""
+        if self._user is _UNSET:
+            self.authLookups += 1
+            self._user = endpoints.get_current_user()
+        return self._user
+
+    def requireUser(self):
+        """Return the current user, raising 401 if there is none."""
+        if not self.user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        return self.user
+
+    @property
+    def userId(self):
+        """Return the user ID of the current user, raising 401 if none."""
+        if self._user_id is _UNSET:
+            user = self.requireUser()
+            self.authLookups += 1
+            self._user_id = getUserId(user)
+        return self._user_id
+
+    @property
+    def profileKey(self):
+        """Return the Profile key of the current user."""
+        return ndb.Key(Profile, self.userId)
+
+    def getProfile(self):
+        """Return user Profile from datastore, creating new one if non-existent."""
+        if self._profile is None:
+            profile = entitycache.get(self.profileKey)
+            if not profile:
+                user = self.requireUser()
+                profile = Profile(
+                    key=self.profileKey,
+                    displayName=user.nickname(),
+                    mainEmail=user.email(),
+                    teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED),
+                )
+                profile.put()
+            self._profile = profile
+        return self._profile
+
+
+def current():
+    """Return the RequestContext of the running request.
+
+    Outside of an @endpoint method (e.g. in task handlers) a new, unshared
+    context is returned.
+    """
+    context = getattr(_local, 'context', None)
+    return context if context is not None else RequestContext()
+
+
+def _countRpc(service, call, request, response, rpc):
+    """apiproxy pre-call hook counting datastore RPCs of the request."""
+    context = getattr(_local, 'context', None)
+    if context is not None:
+        if service == 'datastore_v3':
+            context.datastoreRpcs += 1
+        if context.sample is not None:
+            context.sample.rpcStarted(service, rpc)
+
+
+def _sampleRpc(service, call, request, response, rpc):
+    """apiproxy post-call hook feeding the request's metrics sample."""
+    context = getattr(_local, 'context', None)
+    if context is not None and context.sample is not None:
+        context.sample.rpcFinished(service, call, request, response, rpc)
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+    'requestcontext', _countRpc)
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+    'requestcontext', _sampleRpc)
+
+
+def _record(name, context):
+    """Add the lookups of one call of endpoint name to the totals."""
+    with _stats_lock:
+        stats = _stats.setdefault(
+            name, {'calls': 0, 'datastoreRpcs': 0, 'authLookups': 0})
+        stats['calls'] += 1
+        stats['datastoreRpcs'] += context.datastoreRpcs
+        stats['authLookups'] += context.authLookups
+    logging.debug('%s: %d datastore RPCs, %d auth lookups', name,
+                  context.datastoreRpcs, context.authLookups)
+
+
+def getStats():
+    """Return per endpoint call counts and average lookups per call."""
+    with _stats_lock:
+        stats = dict((name, dict(values)) for name, values in _stats.items())
+    for values in stats.values():
+        values['datastoreRpcsPerCall'] = (
+            float(values['datastoreRpcs']) / values['calls'])
+        values['authLookupsPerCall'] = (
+            float(values['authLookups']) / values['calls'])
+    return stats
+
+
+def _itemCount(response):
+    """Return the number of items of an endpoint response."""
+    items = getattr(response, 'items', None)
+    if isinstance(items, list):
+        return len(items)
+    return 0 if response is None else 1
+
+
+def _run(name, call, count_items=None):
+    """Run call() with a fresh RequestContext, recording its lookups."""
+    context = _local.context = RequestContext(metrics.newSample())
+    started = time.time()
+    result = None
+    failed = True
+    try:
+        result = call()
+        failed = False
+        return result
+    finally:
+        _local.context = None
+        _record(name, context)
+        if context.sample is not None:
+            metrics.record(
+                name, context.sample, time.time() - started,
+                count_items(result) if count_items and not failed else None,
+                failed)
+
+
+def endpoint(method):
+    """Run an endpoint method with a fresh RequestContext."""
+    @functools.wraps(method)
+    def wrapper(service, request):
+        return _run(method.__name__, lambda: method(service, request),
+                    _itemCount)
+    return wrapper
+
+
+def dispatchHandler(router, request, response):
+    """webapp2 dispatcher running every handler with a fresh RequestContext.
+
+    Install with app.router.set_dispatcher(dispatchHandler).
+    """
+    return _run(request.path,
+                lambda: router.default_dispatcher(request, response))
@@ -16,3 +16,21 @@ WEB_CLIENT_ID = '698395795228-bhb70kmm2562coh14as34f4uvbihvnch.apps.googleuserco
 ANDROID_CLIENT_ID = 'replace with Android client ID'
 IOS_CLIENT_ID = 'replace with iOS client ID'
 ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# Number of seat-counter shards created for each new Conference. More shards
+# let more registrations commit in parallel; must stay below the cross-group
+# transaction limit (25 entity groups).
+SEAT_SHARDS = 10
+
+# Token validation endpoint used by utils.getUserId(id_type="oauth"); point
+# it at a local stand-in when testing.
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
+
+# Fraction of requests whose hot-path metrics (wall time, datastore RPCs
+# and latency, memcache hits, urlfetch calls) are recorded by metrics.py;
+# 0 turns the instrumentation off.
+METRICS_SAMPLE_RATE = 0.1
+
+# Upper bound on outbound mails sent per minute by mailoutbox.py (keep it
+# within the app's Mail API quota).
+MAIL_SEND_RATE_PER_MINUTE = 60
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""speakerindex.py
+
+Per-Conference speaker -> session names index behind the featured speaker.
+
+SpeakerIndex.sessionsBySpeaker maps each spelling of a speaker name, as
+typed on the sessions, to the names of that speaker's sessions; spellings
+are only folded together (normalizeName) when counting. The index also
+stores the current featuredSpeaker, so getFeaturedSpeaker is one get of
+the index on a memcache miss rather than a count over the sessions.
+
+"""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Session
+from models import SpeakerIndex
+from speakers import normalizeName
+
+
+MEMCACHE_FEATURED_SPEAKER_KEY = "featured_speaker_"
+FEATURED_SPEAKER_CACHE_SECONDS = 600
+
+
+def indexKey(conf_key):
+    """Return the SpeakerIndex key of a Conference key."""
+    return ndb.Key(SpeakerIndex, 'speakers', parent=conf_key)
+
+
+def _loadIndex(conf_key):
+    """Return the SpeakerIndex of a Conference, building it if missing.
+
+    A missing index is built by reading every session of the conference;
+    this is only paid by conferences whose sessions were stored before the
+    index was introduced.
+    """
+    index = indexKey(conf_key).get()
+    if not index:
+        index = SpeakerIndex(key=indexKey(conf_key), sessionsBySpeaker={})
+        for session in Session.query(ancestor=conf_key):
+            index.sessionsBySpeaker.setdefault(
+                session.speaker, []).append(session.name)
+    return index
+
+
+@ndb.transactional
+def ensureIndex(conf_key):
+    """Build and store the SpeakerIndex of a Conference if it is missing."""
+    if not indexKey(conf_key).get():
+        _loadIndex(conf_key).put()
+
+
+def _sessionNames(index, speaker):
+    """Return the session names of a speaker under every spelling."""
+    normalized = normalizeName(speaker)
+    return [name for spelling, names in sorted(index.sessionsBySpeaker.items())
+            if normalizeName(spelling) == normalized for name in names]
+
+
+@ndb.transactional
+def rebuildIndex(conf_key):
+    """Rebuild the SpeakerIndex of a Conference from all its sessions.
+
+    For sessions written outside addSessions, e.g. by an import; the
+    speaker with the most sessions (more than one) becomes featured.
+    """
+    return addSessions(
+        conf_key, Session.query(ancestor=conf_key).fetch(),
+        SpeakerIndex(key=indexKey(conf_key), sessionsBySpeaker={}))
+
+
+def addSessions(conf_key, sessions, index=None):
+    """Add sessions to the speaker index of their Conference.
+
+    Call it inside the session-creating transaction, which already holds
+    the Conference's entity group. A speaker of the new sessions becomes
+    the featured speaker once they speak more than once, whatever the
+    spelling of their name (the one with the most sessions wins within a
+    batch). index replaces the stored index when given.
+    """
+    if index is None:
+        index = _loadIndex(conf_key)
+    for session in sessions:
+        index.sessionsBySpeaker.setdefault(
+            session.speaker, []).append(session.name)
+
+    counts = {}
+    for spelling, names in index.sessionsBySpeaker.items():
+        normalized = normalizeName(spelling)
+        counts[normalized] = counts.get(normalized, 0) + len(names)
+    candidates = [session.speaker for session in sessions
+                  if counts[normalizeName(session.speaker)] > 1]
+    if candidates:
+        index.featuredSpeaker = max(
+            reversed(candidates),
+            key=lambda speaker: counts[normalizeName(speaker)])
+    index.put()
+
+    # the cached message may name the old featured speaker; drop it once
+    # the new one is committed
+    memcache_key = MEMCACHE_FEATURED_SPEAKER_KEY + conf_key.urlsafe()
+    ndb.get_context().call_on_commit(lambda: memcache.delete(memcache_key))
+    return index
+
+
+def _featuredMessage(index):
+    """Render the featured speaker message of a SpeakerIndex."""
+    if not index or not index.featuredSpeaker:
+        return ""
+    speaker = index.featuredSpeaker
+    return u"Featured speaker is: {}. Sessions include: {}".format(
+        speaker, u', '.join(
+            name for name in _sessionNames(index, speaker) if name))
+
+
+def getFeaturedSpeaker(conf_key):
+    """Return the featured speaker message of a Conference ("" if none)."""
+    memcache_key = MEMCACHE_FEATURED_SPEAKER_KEY + conf_key.urlsafe()
+    message = memcache.get(memcache_key)
+    if message is None:
+        message = _featuredMessage(indexKey(conf_key).get())
+        memcache.set(memcache_key, message,
+                     time=FEATURED_SPEAKER_CACHE_SECONDS)
+    return message
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""speakers.py
+
+Speaker entities: every speaker across all conferences, keyed by the
+normalized form of their name, with the keys of their sessions.
+
+normalizeName() folds case, accents, punctuation and spacing, so "Dr. Jane
+Doe" and "dr jane  doe" are the same speaker; the spellings seen are kept
+as aliases. Looking up a speaker's sessions is one get of the Speaker plus
+one get_multi of its session keys instead of a global query on the
+free-text Session.speaker.
+
+Speakers are root entities, so they cannot join the conference transaction
+that writes sessions. sessionsCreated() enqueues a transactional task
+instead, which adds the new session keys to their speakers, one
+transaction per speaker. Adding a key twice changes nothing, so repeated
+task deliveries and the backfill_speakers batch job are harmless.
+
+"""
+
+import re
+import unicodedata
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Speaker
+
+
+UPDATE_TASK_URL = '/tasks/update_speakers'
+
+
+def normalizeName(name):
+    """Return the lookup form of a speaker name."""
+    name = unicodedata.normalize('NFKD', unicode(name or ''))
+    name = u''.join(c for c in name if not unicodedata.combining(c))
+    name = re.sub(r'[^\w\s]', u' ', name.lower(), flags=re.UNICODE)
+    return u' '.join(name.split())
+
+
+def speakerKey(name):
+    """Return the Speaker key of a (raw or normalized) speaker name."""
+    normalized = normalizeName(name)
+    return ndb.Key(Speaker, normalized) if normalized else None
+
+
+def sessionsCreated(sessions):
+    """Schedule adding new sessions to their speakers.
+
+    Enqueued transactionally when called in the transaction writing the
+    sessions.
+    """
+    taskqueue.add(params={'sessionKeys': ' '.join(
+                      session.key.urlsafe() for session in sessions)},
+                  url=UPDATE_TASK_URL,
+                  transactional=ndb.in_transaction())
+
+
+@ndb.transactional
+def _addToSpeaker(speaker_key, spellings, session_keys):
+    """Add session keys and spellings to one Speaker, creating it."""
+    speaker = speaker_key.get() or Speaker(key=speaker_key,
+                                           name=spellings[0])
+    known = set(speaker.sessionKeys)
+    added = [key for key in session_keys if key not in known]
+    new_aliases = [spelling for spelling in spellings
+                   if spelling not in speaker.aliases]
+    if added or new_aliases:
+        speaker.sessionKeys.extend(added)
+        speaker.aliases.extend(new_aliases)
+        speaker.put()
+
+
+def addSessions(sessions):
+    """Add sessions to the Speaker entities of their speakers."""
+    by_speaker = {}
+    for session in sessions:
+        speaker_key = speakerKey(session.speaker)
+        if speaker_key is None:
+            continue
+        spellings, session_keys = by_speaker.setdefault(
+            speaker_key, ([], []))
+        if session.speaker not in spellings:
+            spellings.append(session.speaker)
+        session_keys.append(session.key)
+    for speaker_key, (spellings, session_keys) in by_speaker.items():
+        _addToSpeaker(speaker_key, spellings, session_keys)
+
+
+def updateSpeakers(websafe_session_keys):
+    """Task body of sessionsCreated(): add the sessions to their speakers."""
+    keys = [ndb.Key(urlsafe=wssk) for wssk in websafe_session_keys.split()]
+    addSessions([session for session in ndb.get_multi(keys) if session])
+
+
+def backfillSpeakers(sessions):
+    """Batch job mapper adding existing sessions to their speakers."""
+    addSessions(sessions)
+    return [], []
+
+
+def getSessionKeys(name):
+    """Return the session keys of a speaker name ([] if unknown)."""
+    speaker_key = speakerKey(name)
+    speaker = speaker_key.get() if speaker_key else None
+    return list(speaker.sessionKeys) if speaker else []
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+"""textsearch.py
+
+Tokenized full-text search over Sessions and Conferences.
+
+Every indexed entity gets a SearchDocument child holding its normalized
+tokens, their prefixes and per-token weights (name matches count more than
+description matches). Documents are written together with their entity, so
+the index is updated on create without a separate service. A query is a
+list of terms, each an exact token or a prefix ("mach*"); all terms must
+match. They become equality filters on the documents' repeated properties,
+which the datastore answers with a merge join over built-in indexes.
+
+Matching documents come in key order, so they are read in windows of
+SEARCH_WINDOW_SIZE and each window is ranked on its own by the summed
+weights of the matched tokens. Pages run through a window best first and
+then move on to the next window; a page token holds the window's query
+cursor and the position in it, so every page costs one window read and
+every match is eventually returned.
+
+"""
+
+import re
+import unicodedata
+
+from google.appengine.ext import ndb
+
+from models import SearchDocument
+
+
+MIN_PREFIX_LENGTH = 2
+MAX_PREFIX_LENGTH = 8
+SEARCH_WINDOW_SIZE = 200
+STOPWORDS = frozenset([
+    'a', 'an', 'and', 'are', 'at', 'by', 'for', 'from', 'in', 'is', 'of',
+    'on', 'or', 'the', 'to', 'with',
+])
+
+# indexed fields of each kind and the weight of a token found in them
+FIELD_WEIGHTS = {
+    'Session': (('name', 3), ('speaker', 2), ('highlights', 1)),
+    'Conference': (('name', 3), ('topics', 2), ('description', 1)),
+}
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Return the normalized tokens of text (lowercase, accents removed)."""
+    if not text:
+        return []
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = u''.join(c for c in text if not unicodedata.combining(c))
+    return [token for token in _WORD_RE.findall(text)
+            if token not in STOPWORDS]
+
+
+def documentKey(entity_key):
+    """Return the SearchDocument key of an indexed entity key."""
+    return ndb.Key(SearchDocument, 'search', parent=entity_key)
+
+
+def documentFor(entity):
+    """Return the (unsaved) SearchDocument of a Session or Conference."""
+    kind = entity.key.kind()
+    weights = {}
+    for field, weight in FIELD_WEIGHTS[kind]:
+        value = getattr(entity, field)
+        if isinstance(value, list):
+            value = u' '.join(value)
+        for token in tokenize(value):
+            weights[token] = weights.get(token, 0) + weight
+
+    prefixes = set()
+    for token in weights:
+        for length in range(MIN_PREFIX_LENGTH,
+                            min(len(token), MAX_PREFIX_LENGTH) + 1):
+            prefixes.add(token[:length])
+    return SearchDocument(key=documentKey(entity.key), kind=kind,
+                          tokens=sorted(weights), prefixes=sorted(prefixes),
+                          weights=weights)
+
+
+def parseQuery(query_string):
+    """Return the (token, is_prefix) terms of a query string."""
+    terms = []
+    for word in (query_string or '').split():
+        tokens = tokenize(word)
+        for i, token in enumerate(tokens):
+            is_prefix = word.endswith('*') and i == len(tokens) - 1
+            if is_prefix and len(token) < MIN_PREFIX_LENGTH:
+                continue
+            if (token, is_prefix) not in terms:
+                terms.append((token, is_prefix))
+    return terms
+
+
+def _score(doc, terms):
+    """Return the rank of doc for terms, or None if a term doesn't match."""
+    score = 0
+    for token, is_prefix in terms:
+        if is_prefix:
+            matched = [weight for candidate, weight in doc.weights.items()
+                       if candidate.startswith(token)]
+            if not matched:
+                return None
+            score += max(matched)
+        else:
+            score += doc.weights.get(token, 0)
+    return score
+
+
+def _pageToken(cursor, position):
+    """Return the page token of a position in the window at cursor."""
+    return '%s:%d' % (cursor.urlsafe() if cursor else '', position)
+
+
+def _parsePageToken(page_token):
+    """Return the (window cursor, position) of a page token.
+
+    Raises ValueError for malformed tokens.
+    """
+    if not page_token:
+        return None, 0
+    cursor, _, position = page_token.rpartition(':')
+    try:
+        return (ndb.Cursor(urlsafe=cursor) if cursor else None,
+                max(int(position), 0))
+    except Exception:
+        raise ValueError('Invalid page token: %s' % page_token)
+
+
+def search(kind, query_string, page_size, page_token=None):
+    """Return (entity keys, next page token or None) of a search page.
+
+    Results are ranked within windows of SEARCH_WINDOW_SIZE matches (see
+    above); page_size is capped at the window size. Raises ValueError for
+    a malformed page_token.
+    """
+    terms = parseQuery(query_string)
+    if not terms:
+        return [], None
+    cursor, position = _parsePageToken(page_token)
+    page_size = min(page_size, SEARCH_WINDOW_SIZE)
+
+    query = SearchDocument.query(SearchDocument.kind == kind)
+    for token, is_prefix in terms:
+        if is_prefix:
+            # longer prefixes are narrowed down by _score
+            query = query.filter(
+                SearchDocument.prefixes == token[:MAX_PREFIX_LENGTH])
+        else:
+            query = query.filter(SearchDocument.tokens == token)
+
+    while True:
+        docs, next_cursor, more = query.fetch_page(
+            SEARCH_WINDOW_SIZE, start_cursor=cursor)
+        ranked = []
+        for doc in docs:
+            score = _score(doc, terms)
+            if score is not None:
+                ranked.append((-score, doc.key))
+        ranked.sort()
+
+        page = ranked[position:position + page_size]
+        if position + page_size < len(ranked):
+            next_token = _pageToken(cursor, position + page_size)
+        elif more and next_cursor:
+            next_token = _pageToken(next_cursor, 0)
+        else:
+            next_token = None
+        # prefix terms may rule out a whole window; skip to the next one
+        if page or not next_token:
+            break
+        cursor, position = next_cursor, 0
+    return [doc_key.parent() for _, doc_key in page], next_token
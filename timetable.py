@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+"""timetable.py
+
+Materialized per-Conference timetable behind getConferenceSessions and
+getConferenceSessionsByType.
+
+A Timetable entity under the Conference stores the SessionForm JSON of
+each session, sorted by date, start time and name, plus a typeOfSession ->
+positions map so the by-type listing is a lookup rather than a filter.
+Readers take the zlib-compressed memcache copy (or get the entity) and
+decode the selected forms with one protojson call; no Session entity is
+read or converted. The forms are frozen at write time, so anything that
+changes a stored session must go through invalidate().
+
+"""
+
+import json
+import zlib
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from protorpc import protojson
+
+import converters
+from models import Session
+from models import SessionForms
+from models import Timetable
+
+
+MEMCACHE_TIMETABLE_KEY = "timetable_"
+TIMETABLE_CACHE_SECONDS = 600
+
+
+def timetableKey(conf_key):
+    """Return the Timetable key of a Conference key."""
+    return ndb.Key(Timetable, 'sessions', parent=conf_key)
+
+
+def _formData(session):
+    """Return the SessionForm JSON object of a Session."""
+    return json.loads(protojson.encode_message(
+        converters.sessionToForm(session)))
+
+
+def _sortKey(form):
+    """Timetable order: date, then start time, then name."""
+    return (form.get('date', ''), form.get('startTime', ''),
+            form.get('name', ''))
+
+
+def _build(conf_key, forms):
+    """Return a Timetable of session forms, sorting them in place."""
+    forms.sort(key=_sortKey)
+    types = {}
+    for position, form in enumerate(forms):
+        for type_of_session in form.get('typeOfSession', ()):
+            types.setdefault(type_of_session, []).append(position)
+    return Timetable(key=timetableKey(conf_key), sessions=forms, types=types)
+
+
+def _loadTimetable(conf_key):
+    """Return the Timetable of a Conference, building it if missing.
+
+    Building converts every session of the conference to its form, so it
+    is only done for a missing timetable, never on a regular update.
+    """
+    timetable = timetableKey(conf_key).get()
+    if not timetable:
+        timetable = _build(conf_key, [
+            _formData(session)
+            for session in Session.query(ancestor=conf_key)])
+    return timetable
+
+
+def _dropCopy(conf_key):
+    """Drop the memcache copy of a Conference's timetable."""
+    memcache.delete(MEMCACHE_TIMETABLE_KEY + conf_key.urlsafe())
+
+
+@ndb.transactional
+def ensureTimetable(conf_key):
+    """Return the stored Timetable of a Conference, building it if missing.
+
+    Returns None if the conference does not exist.
+    """
+    timetable = timetableKey(conf_key).get()
+    if not timetable:
+        if not conf_key.get():
+            return None
+        timetable = _loadTimetable(conf_key)
+        timetable.put()
+    return timetable
+
+
+def addSessions(conf_key, sessions):
+    """Merge sessions into the timetable of their Conference.
+
+    Called from the transaction that puts the sessions, so the timetable
+    never lists a session that failed to commit. The stored list is
+    already sorted, so the sort only has to merge in the new forms.
+    """
+    timetable = _loadTimetable(conf_key)
+    timetable = _build(conf_key, timetable.sessions + [
+        _formData(session) for session in sessions])
+    timetable.put()
+
+    # dropping the compressed copy before commit could let a reader cache
+    # the old list again
+    ndb.get_context().call_on_commit(lambda: _dropCopy(conf_key))
+    return timetable
+
+
+def invalidate(conf_keys):
+    """Drop the timetables of conferences whose sessions were written
+    outside addSessions (e.g. by an import); they are rebuilt on demand."""
+    ndb.delete_multi([timetableKey(conf_key) for conf_key in conf_keys])
+    memcache.delete_multi([MEMCACHE_TIMETABLE_KEY + conf_key.urlsafe()
+                           for conf_key in conf_keys])
+
+
+def _getData(conf_key):
+    """Return {'sessions': [...], 'types': {...}} of a Conference, or None."""
+    cache_key = MEMCACHE_TIMETABLE_KEY + conf_key.urlsafe()
+    cached = memcache.get(cache_key)
+    if cached is not None:
+        return json.loads(zlib.decompress(cached))
+    timetable = timetableKey(conf_key).get() or ensureTimetable(conf_key)
+    if not timetable:
+        return None
+    data = {'sessions': timetable.sessions, 'types': timetable.types}
+    # compressed, so large timetables still fit in a memcache value
+    try:
+        memcache.add(cache_key, zlib.compress(json.dumps(data)),
+                     time=TIMETABLE_CACHE_SECONDS)
+    except ValueError:
+        pass
+    return data
+
+
+def getSessionForms(conf_key, type_of_session=None, mask=None):
+    """Return SessionForms of a Conference's sessions in timetable order.
+
+    Only sessions of type_of_session if given, trimmed to a field mask if
+    given. Returns None if the conference does not exist.
+    """
+    data = _getData(conf_key)
+    if data is None:
+        return None
+    forms = data['sessions']
+    if type_of_session is not None:
+        forms = [forms[position]
+                 for position in data['types'].get(type_of_session, ())]
+    if mask is not None:
+        forms = [dict((name, value) for name, value in form.iteritems()
+                      if name in mask)
+                 for form in forms]
+    return protojson.decode_message(SessionForms,
+                                    json.dumps({'items': forms}))
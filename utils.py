@@ -1,10 +1,108 @@
+import hashlib
 import json
 import os
+import threading
 import time
 import uuid
+from collections import OrderedDict
 
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
 from models import Profile
+from settings import TOKENINFO_URL
+
+MEMCACHE_TOKEN_KEY = "tokeninfo_"
+TOKEN_CACHE_SIZE = 1000
+MAX_TOKEN_CACHE_SECONDS = 3600
+FAILED_TOKEN_SECONDS = 5
+MAX_FAILED_TOKEN_SECONDS = 300
+
+
+class _LRUCache(object):
+    """Small thread-safe in-process LRU of token digest -> cache entry."""
+
+    def __init__(self, size):
+        self._size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+
+_token_cache = _LRUCache(TOKEN_CACHE_SIZE)
+
+
+def _fetchTokenInfo(token):
+    """Ask the tokeninfo service about token; returns its JSON or None."""
+    token_type = 'id_token'
+    if 'OAUTH_USER_ID' in os.environ:
+        token_type = 'access_token'
+    for i in range(2):
+        try:
+            resp = urlfetch.fetch(TOKENINFO_URL % (token_type, token),
+                                  deadline=5)
+        except urlfetch.Error:
+            return None
+        if resp.status_code == 200:
+            return json.loads(resp.content)
+        elif resp.status_code == 400 and 'invalid_token' in resp.content:
+            token_type = 'access_token'
+        else:
+            # don't sleep in the request; the failure is cached with a
+            # growing backoff instead
+            return None
+    return None
+
+
+def _getOAuthUserId(token):
+    """Return the user ID of an OAuth token, using the token cache.
+
+    Valid tokens are cached in-process and in memcache until the token
+    expires (at most MAX_TOKEN_CACHE_SECONDS). Failed lookups are cached
+    too, for FAILED_TOKEN_SECONDS doubling with every consecutive failure.
+    """
+    digest = hashlib.sha256(token).hexdigest()
+    now = time.time()
+
+    entry = _token_cache.get(digest)
+    if entry is None:
+        entry = memcache.get(MEMCACHE_TOKEN_KEY + digest)
+        if entry is not None:
+            _token_cache.set(digest, entry)
+    if entry is not None and entry['expires'] > now:
+        return entry['userId']
+
+    failures = entry['failures'] if entry else 0
+    user = _fetchTokenInfo(token)
+    user_id = user.get('user_id', '') if user else ''
+    if user_id:
+        ttl = min(int(user.get('expires_in', 0)), MAX_TOKEN_CACHE_SECONDS)
+        entry = {'userId': user_id, 'expires': now + ttl, 'failures': 0}
+        keep = ttl
+    else:
+        ttl = min(FAILED_TOKEN_SECONDS * 2 ** failures,
+                  MAX_FAILED_TOKEN_SECONDS)
+        entry = {'userId': '', 'expires': now + ttl,
+                 'failures': failures + 1}
+        # remember the failure count beyond the backoff itself
+        keep = MAX_FAILED_TOKEN_SECONDS * 2
+    if keep > 0:
+        _token_cache.set(digest, entry)
+        memcache.set(MEMCACHE_TOKEN_KEY + digest, entry, time=keep)
+    return user_id
+
 
 def getUserId(user, id_type="email"):
     if id_type == "email":
@@ -14,25 +112,7 @@ def getUserId(user, id_type="email"):
         """A workaround implementation for getting userid."""
         auth = os.getenv('HTTP_AUTHORIZATION')
         bearer, token = auth.split()
-        token_type = 'id_token'
-        if 'OAUTH_USER_ID' in os.environ:
-            token_type = 'access_token'
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-               % (token_type, token))
-        user = {}
-        wait = 1
-        for i in range(3):
-            resp = urlfetch.fetch(url)
-            if resp.status_code == 200:
-                user = json.loads(resp.content)
-                break
-            elif resp.status_code == 400 and 'invalid_token' in resp.content:
-                url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-                       % ('access_token', token))
-            else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+        return _getOAuthUserId(token)
 
     if id_type == "custom":
         # implement your own user_id creation and getting algorythm
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""versionstamp.py
+
+Per-conference version stamps for conditional reads.
+
+Every conference has an opaque version in memcache, replaced with a new
+random value whenever one of its sessions is created or its seats change.
+Read endpoints derive an ETag from it (and their own parameters). A client
+that sends back the current ETag is answered from the version lookup alone.
+An evicted version is simply replaced by a new one, which costs clients one
+full read but can never make a stale ETag match. Readers take the version
+before reading the data, so a response is never labelled newer than it is.
+
+"""
+
+import hashlib
+import uuid
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+
+MEMCACHE_VERSION_KEY = "conf_version_"
+
+
+def _newVersion():
+    """Return a fresh, never reused version value."""
+    return uuid.uuid4().hex
+
+
+def getVersion(conf_key):
+    """Return the current version stamp of a conference."""
+    cache_key = MEMCACHE_VERSION_KEY + conf_key.urlsafe()
+    version = memcache.get(cache_key)
+    if version is None:
+        # another reader may add first; everybody uses the stored value
+        memcache.add(cache_key, _newVersion())
+        version = memcache.get(cache_key) or _newVersion()
+    return version
+
+
+def _bump(wsck):
+    """Replace the version of the conference with urlsafe key wsck."""
+    memcache.set(MEMCACHE_VERSION_KEY + wsck, _newVersion())
+
+
+def bump(conf_key):
+    """Give a conference a new version; deferred to commit in transactions."""
+    wsck = conf_key.urlsafe()
+    if ndb.in_transaction():
+        ndb.get_context().call_on_commit(lambda: _bump(wsck))
+    else:
+        _bump(wsck)
+
+
+def etag(version, *parts):
+    """Return the ETag of a response for version and request parts."""
+    digest = hashlib.md5(
+        '\n'.join([version] + [unicode(part).encode('utf-8')
+                               for part in parts])).hexdigest()
+    return '"%s"' % digest
+
+
+def matches(if_none_match, current):
+    """Return True if an If-None-Match value (or bare ETag) names current."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == '*' or candidate.strip('"') == current.strip('"'):
+            return True
+    return False